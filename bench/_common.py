@@ -0,0 +1,37 @@
+"""ベンチマーク・検証スクリプトの共通部分
+
+リポジトリ直下から `python bench/<スクリプト>.py` で実行する。main.py を読み込み、DBは一時ディレクトリに
+作って終了時に消す（本番のDBには触れない）。検証に失敗したスクリプトは終了コード1で終わる。
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+@asynccontextmanager
+async def temp_db(init=True):
+    """一時DBに向けた main を用意する。init=False ならファイルの場所だけ決めて、移行前のDBを自分で作れるようにする。"""
+    workdir = tempfile.mkdtemp(prefix="omnis_bench_")
+    main.db.path = os.path.join(workdir, "bench.db")
+    main.AUDIT_ARCHIVE_DIR = os.path.join(workdir, "audit_archive")
+    try:
+        if init: await main.init_db()
+        yield main.db.path
+    finally:
+        await main.audit.drain(); await main.role_sync.drain()
+        await main.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def timed(coro):
+    """(結果, 経過秒) を返す。"""
+    t = time.perf_counter(); res = await coro
+    return res, time.perf_counter() - t
+
+def check(ok, msg):
+    if not ok:
+        print(f"FAIL: {msg}"); raise SystemExit(1)
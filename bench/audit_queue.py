@@ -0,0 +1,69 @@
+"""監査ログのバッチ書き込み（user-006）
+
+1. 1件ごとにコミットする旧方式と、AuditWriter のキュー経由を同じ件数で比べる。
+2. 書き込みを途中で失敗させ、失敗したバッチが捨てられずに次の書き込みで入ることを確認する。
+3. 停止時に書き込めないままなら、残りが退避ファイルに出ることを確認する。
+
+    python bench/audit_queue.py [--events 2000]
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from _common import check, main, temp_db, timed
+
+class FlakyWrite:
+    """db.write() を先頭の n 回だけ失敗させる。"""
+    def __init__(self, n):
+        self.n = n; self.orig = main.db.write
+
+    def __call__(self):
+        if self.n > 0:
+            self.n -= 1; raise main.aiosqlite.OperationalError("database is locked (injected)")
+        return self.orig()
+
+async def count():
+    return (await main.db.fetchone("SELECT COUNT(*) FROM audit_logs"))[0]
+
+async def amain(args):
+    main.AUDIT_FLUSH_SEC = 0.05
+    async with temp_db():
+        async def per_event():
+            for k in range(args.events):
+                async with main.db.write() as conn:
+                    await conn.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)", (1, "旧", str(k), k))
+        _, old = await timed(per_event())
+
+        async def queued():
+            for k in range(args.events): main.add_audit(1, "新", str(k))
+            await main.audit.drain()
+        _, new = await timed(queued())
+        print(f"{args.events} events: per-event commits {old:.2f}s / queue {new:.3f}s ({main.audit.commits} commits)")
+        check(await count() == 2 * args.events, "キュー経由の行数が合わない")
+
+        # 一時的な失敗: 2回失敗したあとで全件入る
+        main.db.write = FlakyWrite(2)
+        for k in range(300): main.add_audit(1, "再試行", str(k))
+        await main.audit.drain()
+        main.db.write = main.db.write.orig
+        got = (await main.db.fetchone("SELECT COUNT(*) FROM audit_logs WHERE action='再試行'"))[0]
+        check(got == 300, f"失敗したバッチが失われた: {got}/300")
+        check(main.audit.failed == 2, f"失敗回数 {main.audit.failed} != 2")
+
+        # 停止時も失敗し続ける: 退避ファイルに全件出る
+        main.db.write = FlakyWrite(10**9)
+        for k in range(50): main.add_audit(1, "退避", str(k))
+        await main.audit.drain()
+        main.db.write = main.db.write.orig
+        path = os.path.join(main.AUDIT_ARCHIVE_DIR, "audit_unsaved.jsonl")
+        with open(path, encoding="utf-8") as f: spilled = [json.loads(line) for line in f]
+        check([r["detail"] for r in spilled] == [str(k) for k in range(50)], f"退避ファイルの中身が合わない: {len(spilled)}件")
+        check(not main.audit._pending, "退避後も _pending が残っている")
+        print(f"flush failures {main.audit.failed}, spilled {main.audit.spilled}")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--events", type=int, default=2000)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,75 @@
+"""自動deferと応答の二重送信チェック（user-010）
+
+PERF_DEFER_AFTER を短くし、偽Interactionの応答APIに遅延を入れて次の3通りを流す。
+- 応答（send_message / send_modal）のHTTP呼び出し中に期限を過ぎる → 自動deferせず、応答は1回だけ
+- 応答前に処理が遅い → 自動deferし、reply はフォローアップ、open_modal は押し直しの案内になる
+- どちらでも例外（二重応答）は出ず、API時間がレポートとPrometheus出力に載る
+
+    python bench/auto_defer.py [--defer-ms 50] [--api-ms 100]
+"""
+import argparse
+import asyncio
+
+from _common import check, main, temp_db
+
+import loadsim  # noqa: E402
+
+class SlowResponse(loadsim.FakeResponse):
+    """本物と同じく、HTTP呼び出しが返ってから is_done() が立つ応答。"""
+    delay = 0.0
+
+    async def send_message(self, content=None, **kw):
+        await asyncio.sleep(self.delay); self._ack("message", content=content, **kw)
+
+    async def send_modal(self, modal):
+        await asyncio.sleep(self.delay); self._ack("modal", modal=modal)
+
+    async def defer(self, **kw):
+        await asyncio.sleep(self.delay); self._ack("defer", **kw)
+
+async def run(name, handler, api_sec):
+    SlowResponse.delay = api_sec
+    guild = loadsim.FakeGuild(); i = loadsim.FakeInteraction(loadsim.FakeMember(1), guild, 0)
+    i.response = SlowResponse(i)
+    async with main.perf.measure(name, i): await handler(i)
+    return i
+
+async def amain(args):
+    main.PERF_DEFER_AFTER = args.defer_ms / 1000; api = args.api_ms / 1000; slow = 2 * main.PERF_DEFER_AFTER
+    modal = main.GenericModal("t", "t", None)
+
+    async def slow_then(fn):
+        await asyncio.sleep(slow); await fn()
+
+    async with temp_db():
+        cases = [
+            ("send_in_flight", lambda i: main.reply(i, "ok"), api, ["message"]),
+            ("modal_in_flight", lambda i: main.open_modal(i, modal), api, ["modal"]),
+            ("slow_reply", lambda i: slow_then(lambda: main.reply(i, "ok")), 0, ["defer", "followup"]),
+            ("slow_edit", lambda i: slow_then(lambda: main.edit(i, content="ok")), 0, ["defer", "edit_original"]),
+            ("slow_modal", lambda i: slow_then(lambda: main.open_modal(i, modal)), 0, ["defer", "followup"]),
+        ]
+        for name, handler, api_sec, want in cases:
+            i = await run(name, handler, api_sec)
+            got = [k for k, _ in i.sent]
+            check(got == want, f"{name}: 応答 {got} != {want}")
+            check(i.id not in main._responding and i.id not in main._deferring, f"{name}: 応答中の印が残っている")
+            print(f"{name:<16} {' -> '.join(got)}")
+
+        t = main.perf.totals
+        check(t["send_in_flight"][4] == 0 and t["modal_in_flight"][4] == 0, "HTTP呼び出し中に自動deferした")
+        check(all(t[n][4] == 1 for n in ("slow_reply", "slow_edit", "slow_modal")), "遅い処理で自動deferしていない")
+        check(t["send_in_flight"][5] >= args.api_ms * 0.9 and t["send_in_flight"][6] == 1, f"API時間が数えられていない: {t['send_in_flight']}")
+        check(t["slow_reply"][6] == 2, f"defer + followup の2回になっていない: {t['slow_reply']}")
+        prom = main.perf.prometheus()
+        check('omnis_handler_api_ms_sum{handler="send_in_flight"}' in prom and "omnis_handler_api_calls_total" in prom, "Prometheus出力にAPI時間がない")
+        main.PERF_SAMPLE_RATE = 1.0
+        async with main.perf.measure("sampled", None): await main._api(asyncio.sleep(0.01))
+        check("API" in main.perf.report(), "性能レポートにAPIの割合がない")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--defer-ms", type=int, default=50)
+    p.add_argument("--api-ms", type=int, default=100)
+    asyncio.run(amain(p.parse_args()))
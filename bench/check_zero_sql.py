@@ -0,0 +1,81 @@
+"""読み取り専用パネル操作のSQLゼロ確認（user-004）
+
+全プール接続（書き込み用 + 読み取り用）に sqlite3 のトレースコールバックを付け、マスタキャッシュだけを参照するはずの
+パネル操作をloadsimの偽Interactionで流す。SQLが1文でも実行されたら、その文と操作名を表示して失敗する。
+モーダルの確定（＝書き込み）までは進めない。
+
+    python bench/check_zero_sql.py [--products 60] [--materials 40]
+"""
+import argparse
+import asyncio
+
+from _common import check, main, temp_db
+
+import loadsim  # noqa: E402
+
+async def trace_all(fn):
+    for conn in [main.db.writer, *main.db._readers._queue]:
+        await conn._execute(conn._conn.set_trace_callback, fn)
+
+async def amain(args):
+    async with temp_db():
+        async with main.db.write() as conn:
+            await conn.executemany("INSERT INTO materials (name, current) VALUES (?, 100)", [(f"素材{k:03d}",) for k in range(args.materials)])
+            await conn.executemany("INSERT INTO products (name, price, current) VALUES (?, ?, 10)", [(f"商品{k:03d}", 100 + k) for k in range(args.products)])
+            await conn.executemany("INSERT INTO recipes VALUES (?,?,2)", [(f"商品{k:03d}", f"素材{k % args.materials:03d}") for k in range(args.products)])
+            await conn.execute("INSERT INTO recipe_parts VALUES ('商品001', '商品000', 1)")
+        await main.cache.load(); await main.audit.drain()
+
+        guild = loadsim.FakeGuild()
+        admin = loadsim.FakeMember(1, [guild.get_role(main.ADMIN_ROLE_ID)])
+        worker = loadsim.FakeMember(2, [guild.get_role(main.OMNIS_ROLE_ID), guild.get_role(main.WORK_ROLE_ID)])
+        item, general = main.ItemPanel(), main.GeneralPanel()
+
+        def it(user, ch): return loadsim.FakeInteraction(user, guild, ch)
+        def view_of(i): return (i.first("message") or {}).get("view")
+        def picker_next(view): return next(c for c in view.children if getattr(c, "label", None) == "▶")
+
+        async def reg():
+            i = it(admin, main.ITEM_PANEL_CH); await loadsim.click(item, "reg", i)
+            await picker_next(view_of(i)).callback(it(admin, main.ITEM_PANEL_CH))
+            await loadsim.pick(view_of(i), "商品050", it(admin, main.ITEM_PANEL_CH))   # 2ページ目以降は検索経由
+
+        async def mat_adj():
+            i = it(admin, main.ITEM_PANEL_CH); await loadsim.click(item, "mat_adj", i)
+            await loadsim.pick(view_of(i), "素材000", it(admin, main.ITEM_PANEL_CH))
+
+        async def stock_view():
+            await loadsim.click(item, "stock_view", it(admin, main.ITEM_PANEL_CH))
+
+        async def recipe():
+            pc = main.ProductControlView("商品001")
+            i = it(admin, main.ITEM_PANEL_CH); await pc.recipe.callback(i)
+            i2 = it(admin, main.ITEM_PANEL_CH); await loadsim.pick(view_of(i), "商品001", i2)
+            await loadsim.pick(view_of(i2), "素材001", it(admin, main.ITEM_PANEL_CH))
+
+        async def craft():
+            i = it(worker, main.GENERAL_PANEL_CH); await loadsim.click(general, "craft", i)
+            await picker_next(view_of(i)).callback(it(worker, main.GENERAL_PANEL_CH))
+            await loadsim.pick(view_of(i), "商品001", it(worker, main.GENERAL_PANEL_CH))
+
+        async def sale():
+            i = it(worker, main.GENERAL_PANEL_CH); await loadsim.click(general, "sale", i)
+            await loadsim.pick(view_of(i), "商品030", it(worker, main.GENERAL_PANEL_CH))
+
+        seen0 = main.cache.hits + main.cache.misses; loads0 = main.cache.loads
+        for fn in (reg, mat_adj, stock_view, recipe, craft, sale):
+            sql = []; await trace_all(sql.append)
+            await fn()
+            await trace_all(None)
+            check(not sql, f"{fn.__name__} がSQLを実行した: {sql}")
+            print(f"{fn.__name__:<11} 0 statements")
+        check(main.cache.hits + main.cache.misses > seen0, "キャッシュが参照されていない")
+        check(main.cache.loads == loads0, "パネル操作でキャッシュを読み直した")
+        print(f"cache {main.cache.stats()}")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--products", type=int, default=60)
+    p.add_argument("--materials", type=int, default=40)
+    asyncio.run(amain(p.parse_args()))
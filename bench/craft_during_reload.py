@@ -0,0 +1,53 @@
+"""マスタ読み直し中の制作（user-016 / user-008）
+
+制作を何本も同時に流しながら、キャッシュの全件読み直し（一括インポートの適用）を繰り返す。
+読み直しの途中でもレシピどおりに素材が減る（空のレシピで素材なしの制作が通らない）こと、
+読み直しと重なってコミットした制作がキャッシュから消えず、キャッシュとDBが一致することを確認する。
+
+    python bench/craft_during_reload.py [--crafters 8] [--reloads 10]
+"""
+import argparse
+import asyncio
+
+from _common import check, main, temp_db
+
+IRON = 100000
+
+async def amain(args):
+    async with temp_db():
+        async with main.db.write() as conn:
+            await conn.execute("INSERT INTO materials (name, current) VALUES ('iron', ?)", (IRON,))
+            await conn.execute("INSERT INTO products (name, price, current) VALUES ('sword', 100, 0)")
+            await conn.execute("INSERT INTO recipes VALUES ('sword', 'iron', 1)")
+            # 読み直しに時間がかかるよう、無関係な商品を多めに入れておく
+            await conn.executemany("INSERT INTO products (name) VALUES (?)", [(f"商品{k:05d}",) for k in range(5000)])
+        await main.cache.load()
+        plan = main.parse_import("reload.csv", "type,name,price\nproduct,sword,100\n".encode())
+        crafted = 0; done = False
+
+        async def crafter():
+            nonlocal crafted
+            while not done:
+                res = await main.craft_product(1, "sword", 1)
+                if res.ok: crafted += 1
+                await asyncio.sleep(0)
+
+        async def reloader():
+            nonlocal done
+            for _ in range(args.reloads): await main.apply_import(plan, 1); await asyncio.sleep(0.005)
+            done = True
+
+        await asyncio.gather(reloader(), *(crafter() for _ in range(args.crafters)))
+        await main.audit.drain()
+        iron, sword = (r[0] for r in await main.db.fetchall("SELECT current FROM materials WHERE name='iron' UNION ALL SELECT current FROM products WHERE name='sword'"))
+        print(f"{args.crafters} crafters x {args.reloads} reloads: crafted {crafted}, iron used {IRON - iron}, swords {sword}")
+        check(IRON - iron == crafted and sword == crafted, "素材を使わずに制作された（または数が合わない）")
+        check(main.cache.materials["iron"].current == iron and main.cache.products["sword"].current == sword,
+              f"読み直しでコミット済みの制作がキャッシュから消えた: cache iron={main.cache.materials['iron'].current} / DB {iron}")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--crafters", type=int, default=8)
+    p.add_argument("--reloads", type=int, default=10)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,66 @@
+"""マスタ一括インポート（user-008）
+
+50,000行のレシピ + 1,500行のマスタをCSVで読み込み、解析・検証と適用の時間を測る。
+あわせて次を確認する。
+- 見出しに不明な列（qty など）があるCSV、知らないキーを持つJSON行、負の price / current は取り込まない
+- 確認から適用までの間に参照先の素材が消えたら、何も変えずに `!import` のやり直しを案内する
+
+    python bench/import_50k.py [--products 1000] [--materials 500] [--recipes 50000]
+"""
+import argparse
+import asyncio
+import csv
+import io
+import random
+
+from _common import check, main, temp_db, timed
+
+import loadsim  # noqa: E402
+
+def build_csv(args, rng):
+    out = io.StringIO(); w = csv.writer(out)
+    w.writerow(main.IMPORT_FIELDS)
+    for k in range(args.products): w.writerow(["product", f"商品{k:04d}", 100 + k, 10, "", "", ""])
+    for k in range(args.materials): w.writerow(["material", f"素材{k:04d}", "", 1000, "", "", ""])
+    pairs = rng.sample(range(args.products * args.materials), args.recipes)
+    for x in pairs: w.writerow(["recipe", f"商品{x // args.materials:04d}", "", "", f"素材{x % args.materials:04d}", "", rng.randint(1, 5)])
+    w.writerow(["part", "商品0001", "", "", "", "商品0000", 2])
+    return out.getvalue().encode()
+
+async def amain(args):
+    rng = random.Random(1)
+    async with temp_db():
+        data = build_csv(args, rng)
+        plan, parse_s = await timed(asyncio.to_thread(main.parse_import, "master.csv", data))
+        check(not plan.errors, f"検証エラー: {plan.errors[:3]}")
+        _, apply_s = await timed(main.apply_import(plan, 1))
+        n = (await main.db.fetchone("SELECT (SELECT COUNT(*) FROM recipes), (SELECT COUNT(*) FROM products), (SELECT COUNT(*) FROM recipe_parts)"))
+        check(n == (args.recipes, args.products, 1), f"適用後の行数が合わない: {n}")
+        print(f"{plan.rows:,} rows: parse+validate {parse_s:.2f}s / apply {apply_s:.2f}s")
+
+        bad = main.parse_import("typo.csv", b"type,name,qty\nproduct,x,1\n")
+        check(bad.errors and "qty" in bad.errors[0] and not bad.products, f"不明な列で止まらない: {bad.errors}")
+        bad = main.parse_import("typo.jsonl", '{"type": "product", "name": "x", "prices": 5}\n'.encode())
+        check(bad.errors and "prices" in bad.errors[0], f"JSONの不明なキーで止まらない: {bad.errors}")
+        bad = main.parse_import("neg.json", '[{"type": "material", "name": "素材0001", "current": -5}]'.encode())
+        check(bad.errors and not bad.materials, f"負の在庫を受け付けた: {bad.errors}")
+
+        # 確認ボタンを押す前に、レシピが参照する素材を削除する
+        plan = main.parse_import("late.csv", "type,name,material,quantity\nrecipe,商品0000,素材0000,9\n".encode())
+        check(not plan.errors, f"検証エラー: {plan.errors}")
+        async with main.db.write() as conn: await conn.execute("DELETE FROM materials WHERE name='素材0000'")
+        main.cache.drop_material("素材0000")
+        guild = loadsim.FakeGuild(); admin = loadsim.FakeMember(1, [guild.get_role(main.ADMIN_ROLE_ID)])
+        i = loadsim.FakeInteraction(admin, guild, main.ITEM_PANEL_CH)
+        await loadsim.click(main.ImportConfirmView(plan, admin.id), "apply_btn", i)
+        check("!import" in i.text, f"やり直しの案内が出ない: {i.text}")
+        left = await main.db.fetchone("SELECT COUNT(*) FROM recipes WHERE material_name='素材0000'")
+        check(left == (0,), "外部キー違反の適用が残っている")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--products", type=int, default=1000)
+    p.add_argument("--materials", type=int, default=500)
+    p.add_argument("--recipes", type=int, default=50000)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,98 @@
+"""売上台帳と監査ログ文面の集計比較（user-015）
+
+同じ売上を台帳（sales）と旧来の監査ログ文面（"{商品} x{数} ({金額}円)"）の両方に入れ、
+4種類の集計を台帳のSQLと「監査ログを走査して正規表現で読む」旧方式で比べる（3回中の最速）。
+両者の結果が一致することも確認する。
+
+    python bench/ledger_vs_audit.py [--sales 1000000] [--noise 200000]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from _common import check, main, temp_db
+
+T0 = 1735657200   # 2025-01-01 00:00 JST
+YEAR = 365 * 86400
+USERS, PRODUCTS = 200, 300
+
+async def best_of(fn, n=3):
+    best = None
+    for _ in range(n):
+        t = time.perf_counter(); res = await fn(); sec = time.perf_counter() - t
+        best = sec if best is None or sec < best else best
+    return res, best * 1000
+
+async def scan(lo, hi, user=None, product=None):
+    """旧方式: 売上の監査行を期間で引き、文面を正規表現で読む（商品は文面の前方一致でしか絞れない）。"""
+    sql = "SELECT user_id, detail FROM audit_logs WHERE action='売上' AND created_at >= ? AND created_at < ?"
+    params = (lo, hi)
+    if user is not None: sql += " AND user_id = ?"; params += (user,)
+    if product is not None: sql += " AND detail LIKE ?"; params += (product + " x%",)
+    for uid, detail in await main.db.fetchall(sql, params):
+        if (m := main.SALE_DETAIL_RE.match(detail)): yield uid, m[1], int(m[2]), int(m[3].replace(",", ""))
+
+async def amain(args):
+    rng = random.Random(1)
+    async with temp_db():
+        sales = []
+        for _ in range(args.sales):
+            p = rng.randrange(PRODUCTS); q = rng.randint(1, 5)
+            sales.append((rng.randrange(USERS), f"商品{p:03d}", q, 100 + p, T0 + rng.randrange(YEAR)))
+        sales.sort(key=lambda r: r[4])
+        async with main.db.write() as conn:
+            await conn.executemany("INSERT INTO sales (user_id, product, qty, unit_price, ts) VALUES (?,?,?,?,?)", sales)
+            await conn.executemany("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?, '売上', ?, ?)",
+                                   ((u, f"{p} x{q} ({q * pr:,}円)", ts) for u, p, q, pr, ts in sales))
+            await conn.executemany("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?, '在庫調整', 'x +1', ?)",
+                                   ((rng.randrange(USERS), T0 + rng.randrange(YEAR)) for _ in range(args.noise)))
+        async with main.db.write() as conn: await conn.execute("ANALYZE")
+        m_lo, m_hi = T0 + 120 * 86400, T0 + 151 * 86400
+
+        async def ledger_month():
+            return {p: (q, a) for p, q, a in await main.db.fetchall(
+                "SELECT product, SUM(qty), SUM(qty * unit_price) FROM sales WHERE ts >= ? AND ts < ? GROUP BY product", (m_lo, m_hi))}
+        async def audit_month():
+            out = {}
+            async for _, p, q, a in scan(m_lo, m_hi):
+                t = out.setdefault(p, [0, 0]); t[0] += q; t[1] += a
+            return {p: tuple(t) for p, t in out.items()}
+
+        async def ledger_users():
+            return dict(await main.db.fetchall("SELECT user_id, SUM(qty * unit_price) FROM sales GROUP BY user_id"))
+        async def audit_users():
+            out = {}
+            async for u, _, _, a in scan(0, 2**62): out[u] = out.get(u, 0) + a
+            return out
+
+        async def ledger_product():
+            return tuple(await main.db.fetchone("SELECT SUM(qty), SUM(qty * unit_price) FROM sales WHERE product = ? AND ts >= ? AND ts < ?",
+                                                ("商品007", T0, T0 + YEAR)))
+        async def audit_product():
+            q = a = 0
+            async for _, p, n, amt in scan(T0, T0 + YEAR, product="商品007"):
+                if p == "商品007": q += n; a += amt
+            return q, a
+
+        async def ledger_user_month():
+            return tuple(await main.db.fetchone("SELECT SUM(qty), SUM(qty * unit_price) FROM sales WHERE user_id = ? AND ts >= ? AND ts < ?",
+                                                (7, m_lo, m_hi)))
+        async def audit_user_month():
+            q = a = 0
+            async for _, _, n, amt in scan(m_lo, m_hi, 7): q += n; a += amt
+            return q, a
+
+        print(f"{args.sales:,} sales + {args.sales + args.noise:,} audit rows, best of 3, ledger SQL vs audit scan + regex:")
+        for label, new, old in (("month by product", ledger_month, audit_month), ("all-time by user", ledger_users, audit_users),
+                                ("one product/year", ledger_product, audit_product), ("one user/month", ledger_user_month, audit_user_month)):
+            (a, ms_new), (b, ms_old) = await best_of(new), await best_of(old)
+            check(a == b, f"{label}: 台帳と監査ログの結果が違う")
+            print(f"  {label:<17} {ms_new:7.1f}ms vs {ms_old:7.1f}ms")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--sales", type=int, default=1000000)
+    p.add_argument("--noise", type=int, default=200000)
+    asyncio.run(amain(p.parse_args()))
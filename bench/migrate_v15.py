@@ -0,0 +1,118 @@
+"""スキーマ移行（user-003）: v15 のDBを作って init_db() で最新まで上げる
+
+v15 の実データで起こりうる形をわざと含める。
+- 文字列の日時（マイクロ秒あり・なし混在）
+- 二重クリックで重複した出勤中の行（同じユーザーに end IS NULL が複数）
+- 存在しない商品を指すレシピ行
+- 売上の監査ログ（文面から累計・日次集計・台帳を復元する）とランキング
+
+移行が通ること、行数・出勤中の行・孤立レシピの扱い、累計（user_totals）と日次集計が元データから計算した値と一致することを確認し、出勤確認と集計のクエリ時間を前後で比べる。
+
+    python bench/migrate_v15.py [--shifts 300000] [--users 60]
+"""
+import argparse
+import asyncio
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from _common import check, main, temp_db, timed
+
+V15_SCHEMA = """
+CREATE TABLE work_logs(user_id INTEGER, start DATETIME, end DATETIME, duration INTEGER DEFAULT 0);
+CREATE TABLE materials(name TEXT PRIMARY KEY, current INTEGER DEFAULT 0);
+CREATE TABLE products(name TEXT PRIMARY KEY, price INTEGER DEFAULT 0, current INTEGER DEFAULT 0);
+CREATE TABLE recipes(product_name TEXT, material_name TEXT, quantity INTEGER, PRIMARY KEY(product_name, material_name));
+CREATE TABLE sales_ranking(user_id INTEGER PRIMARY KEY, total_amount INTEGER DEFAULT 0);
+CREATE TABLE audit_logs(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, detail TEXT, created_at DATETIME);
+INSERT INTO products VALUES ('a', 1, 0);
+INSERT INTO materials VALUES ('m', 5);
+INSERT INTO recipes VALUES ('a', 'm', 2), ('ghost', 'm', 1);
+"""
+
+def build_v15(path, shifts, users, rng):
+    c = sqlite3.connect(path); c.executescript(V15_SCHEMA)
+    base = datetime(2026, 1, 1)
+    rows = []
+    for k in range(shifts):
+        s = base + timedelta(minutes=k, microseconds=rng.choice([0, 1234]))
+        rows.append((k % users, str(s), str(s + timedelta(hours=2)), 120))
+    for u in range(users): rows.append((u, str(base + timedelta(days=400)), None, 0))
+    # 二重クリックの名残: ユーザー0は2行、ユーザー1は3行が出勤中
+    dup = [(0, str(base + timedelta(days=400, seconds=1)), None, 0),
+           (1, str(base + timedelta(days=400, seconds=1)), None, 0), (1, str(base + timedelta(days=400, seconds=2)), None, 0)]
+    c.executemany("INSERT INTO work_logs VALUES (?,?,?,?)", rows + dup)
+    c.executemany("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)",
+                  [(1, "x", "y", str(base + timedelta(seconds=k))) for k in range(50000)])
+    ranking = {}
+    for k in range(20000):
+        u = k % users; q = rng.randint(1, 5); amt = q * 150; ranking[u] = ranking.get(u, 0) + amt
+        c.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?, '売上', ?, ?)",
+                  (u, f"a x{q} ({amt:,}円)", str(base + timedelta(minutes=37 * k))))
+    c.executemany("INSERT INTO sales_ranking VALUES (?,?)", ranking.items())
+    c.commit(); c.close()
+    return len(rows) + len(dup)
+
+def bench_queries(path, users):
+    c = sqlite3.connect(path)
+    t = time.perf_counter()
+    for u in range(users): c.execute("SELECT start FROM work_logs WHERE user_id=? AND end IS NULL", (u,)).fetchone()
+    lookup = (time.perf_counter() - t) / users * 1000
+    t = time.perf_counter()
+    for _ in range(5): c.execute("SELECT user_id, SUM(duration) FROM work_logs GROUP BY user_id").fetchall()
+    stats = (time.perf_counter() - t) / 5 * 1000
+    c.close()
+    return lookup, stats
+
+async def amain(args):
+    async with temp_db(init=False) as path:
+        total = build_v15(path, args.shifts, args.users, random.Random(1))
+        before = bench_queries(path, args.users)
+        _, sec = await timed(main.init_db())
+
+        version = (await main.db.fetchone("SELECT MAX(version) FROM schema_version"))[0]
+        check(version == main.MIGRATIONS[-1][0], f"schema_version {version}")
+        n = (await main.db.fetchone("SELECT COUNT(*) FROM work_logs"))[0]
+        check(n == total, f"work_logs の行数 {n} != {total}")
+        open_rows = await main.db.fetchall("SELECT user_id, COUNT(*) FROM work_logs WHERE end IS NULL GROUP BY user_id")
+        check(len(open_rows) == args.users and all(c == 1 for _, c in open_rows), "出勤中の行がユーザーごとに1行になっていない")
+        latest = dict(await main.db.fetchall("SELECT user_id, start FROM work_logs WHERE end IS NULL AND user_id IN (0, 1)"))
+        base = datetime(2026, 1, 1) + timedelta(days=400)
+        check(latest == {0: int((base + timedelta(seconds=1)).timestamp()), 1: int((base + timedelta(seconds=2)).timestamp())},
+              f"最新の出勤行が残っていない: {latest}")
+        closed = (await main.db.fetchone("SELECT COUNT(*) FROM work_logs WHERE end = start AND duration = 0"))[0]
+        check(closed == 3, f"長さ0で閉じた重複行 {closed} != 3")
+        check(await main.db.fetchall("SELECT product_name FROM recipes") == [("a",)], "孤立したレシピ行が残っている")
+
+        # 累計を元データから数え直して比べる
+        want = {}
+        def add(kinds, uid, ts, work=0, sales=0):
+            for k in kinds:
+                t = want.setdefault((main.bucket_key(k, ts), uid), [0, 0]); t[0] += work; t[1] += sales
+        for uid, end, dur in await main.db.fetchall("SELECT user_id, end, duration FROM work_logs WHERE end IS NOT NULL"):
+            add(main.TOTAL_BUCKETS, uid, end, work=dur)
+        for uid, detail, ts in await main.db.fetchall("SELECT user_id, detail, created_at FROM audit_logs WHERE action='売上'"):
+            add(("d", "w", "m"), uid, ts, sales=int(main.SALE_DETAIL_RE.match(detail)[3].replace(",", "")))
+        for uid, amt in await main.db.fetchall("SELECT user_id, total_amount FROM sales_ranking"): add(("all",), uid, 0, sales=amt)
+        got = {(b, u): [w, s] for b, u, w, s in await main.db.fetchall("SELECT bucket, user_id, work_minutes, sales_amount FROM user_totals")}
+        check(got == want, f"user_totals が元データと合わない（{len(got)} / {len(want)} 行）")
+        daily = {}
+        for uid, start, end in await main.db.fetchall("SELECT user_id, start, end FROM work_logs WHERE end IS NOT NULL"):
+            for d, m in main.split_days(start, end): daily[(d, uid)] = daily.get((d, uid), 0) + m
+        check(dict(((d, u), m) for d, u, m in await main.db.fetchall("SELECT day, user_id, minutes FROM daily_work")) == daily,
+              "daily_work が勤怠記録を日ごとに割った値と合わない")
+        sold = await main.db.fetchone("SELECT SUM(amount) FROM daily_sales")
+        check(sold[0] == sum(v[1] for (b, _), v in want.items() if b.startswith("m:")), "daily_sales の合計が売上の監査ログと合わない")
+        await main.db.close()
+
+        after = bench_queries(path, args.users)
+        print(f"v15 -> v{version}: {total:,} shifts migrated in {sec:.2f}s")
+        print(f"open-shift lookup {before[0]:.2f}ms -> {after[0]:.3f}ms / stats GROUP BY {before[1]:.1f}ms -> {after[1]:.1f}ms")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--shifts", type=int, default=300000)
+    p.add_argument("--users", type=int, default=60)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,111 @@
+"""常設パネルの再起動（user-011）
+
+Discord API 1回ごとに遅延を入れた偽チャンネルで startup() と on_ready() を流し、次を確認する。
+- 初回起動はパネルとダッシュボードを送り、再起動では既存メッセージを再利用して送り直さない
+- 再接続（2回目の on_ready）は何もしない
+- fetch が 5xx・send が失敗したチャンネルは重複送信せず、失敗した分だけ再試行して揃う
+- 全部が成功するまで _panels_ready は立たない
+
+    python bench/panels_restart.py [--latency-ms 80]
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+import discord
+
+from _common import check, main, temp_db
+
+LAT = 0.08
+_ids = itertools.count(1000)
+
+class Resp:
+    def __init__(self, status): self.status = status; self.reason = str(status)
+
+class Msg:
+    def __init__(self, ch, mid): self.ch = ch; self.id = mid
+    async def delete(self): self.ch.calls += 1; await asyncio.sleep(LAT); self.ch.msgs.pop(self.id, None)
+
+class Partial:
+    def __init__(self, ch, mid): self.ch = ch; self.id = mid
+    async def edit(self, **kw):
+        self.ch.calls += 1; await asyncio.sleep(LAT)
+        if self.id not in self.ch.msgs: raise discord.NotFound(Resp(404), "unknown message")
+        return self.ch.msgs[self.id]
+
+class Channel:
+    def __init__(self, cid):
+        self.id = cid; self.msgs = {}; self.calls = 0; self.sends = 0
+        self.fail_fetch = 0; self.fail_send = 0   # 先頭の n 回を 503 にする
+
+    async def send(self, *a, **kw):
+        self.calls += 1; await asyncio.sleep(LAT)
+        if self.fail_send: self.fail_send -= 1; raise discord.HTTPException(Resp(503), "unavailable")
+        self.sends += 1; m = Msg(self, next(_ids)); self.msgs[m.id] = m
+        return m
+
+    async def fetch_message(self, mid):
+        self.calls += 1; await asyncio.sleep(LAT)
+        if self.fail_fetch: self.fail_fetch -= 1; raise discord.HTTPException(Resp(503), "unavailable")
+        if mid not in self.msgs: raise discord.NotFound(Resp(404), "unknown message")
+        return self.msgs[mid]
+
+    def get_partial_message(self, mid): return Partial(self, mid)
+
+async def boot(chans):
+    """プロセス再起動に相当: 起動時の記録を戻して on_ready() を流す。"""
+    main._panels_ready = False; main._startup_done.clear()
+    for c in chans.values(): c.calls = 0; c.sends = 0
+    t = time.perf_counter(); await main.on_ready()
+    return (time.perf_counter() - t) * 1000
+
+async def amain(args):
+    global LAT
+    LAT = args.latency_ms / 1000
+    main.PANEL_RETRY_SEC = (LAT, LAT)
+    chans = {cid: Channel(cid) for cid in {p[1] for p in main.PANELS} | {main.ITEM_PANEL_CH}}
+    main.bot.get_channel = chans.get
+    async with temp_db(init=False):
+        t = time.perf_counter(); await main.startup(); startup_ms = (time.perf_counter() - t) * 1000
+        main.audit_maintenance.cancel()
+        try:
+            first = await boot(chans); first_sends = sum(c.sends for c in chans.values())
+            check(main._panels_ready, "初回起動でパネルが揃っていない")
+            msgs = {cid: set(c.msgs) for cid, c in chans.items()}
+
+            again = await boot(chans); calls = sum(c.calls for c in chans.values())
+            check(sum(c.sends for c in chans.values()) == 0 and {cid: set(c.msgs) for cid, c in chans.items()} == msgs, "再起動でメッセージを送り直した")
+            before = calls; await main.on_ready()
+            check(sum(c.calls for c in chans.values()) == before, "再接続の on_ready がAPIを呼んだ")
+            print(f"startup {startup_ms:.0f}ms / first boot panels {first:.0f}ms ({first_sends} sends) / restart panels {again:.0f}ms ({calls} calls)")
+
+            # 一時的な失敗: admin は fetch が1回 503、general は send が1回 503（保存済みの行を消して送り直しを強制）
+            admin, general = chans[main.ADMIN_PANEL_CH], chans[main.GENERAL_PANEL_CH]
+            admin.fail_fetch = 1
+            async with main.db.write() as conn: await conn.execute("DELETE FROM panel_messages WHERE key='general'")
+            general.msgs.clear(); general.fail_send = 1
+            main._panels_ready = False; main._startup_done.clear()
+            seen = []
+            orig = main._startup_pass
+            async def spy(): ok = await orig(); seen.append((ok, main._panels_ready)); return ok
+            main._startup_pass = spy
+            await main.on_ready()
+            main._startup_pass = orig
+            check(seen[0] == (False, False) and seen[-1][0] and main._panels_ready, f"失敗からの再試行で揃わない: {seen}")
+            check(len(admin.msgs) == 1 and len(general.msgs) == 1, f"重複したパネル: admin={len(admin.msgs)} general={len(general.msgs)}")
+            print(f"transient 503: recovered after {len(seen)} passes, no duplicate panels")
+
+            # 失敗し続ける: 再試行を使い切っても _panels_ready は立たない
+            main._panels_ready = False; main._startup_done.clear(); admin.fail_fetch = 10
+            await main.on_ready()
+            check(not main._panels_ready and "admin" not in main._startup_done and "general" in main._startup_done, "失敗したままなのに完了扱い")
+            check(len(admin.msgs) == 1, "失敗中に重複送信した")
+            print("OK")
+        finally:
+            if main.dashboard.task: main.dashboard.task.cancel()
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--latency-ms", type=int, default=80)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,55 @@
+"""ページ付き・前方一致検索つきピッカー（user-007）
+
+10,000商品のカタログで、売上報告のピッカーを開く時間と prefix_page() 1回の時間を測る。
+どのページ・検索結果もセレクトの25件上限に収まり、SQLを使わないことも確認する。
+
+    python bench/picker.py [--products 10000] [--opens 200]
+"""
+import argparse
+import asyncio
+import time
+
+from _common import check, main, temp_db
+
+import loadsim  # noqa: E402
+
+async def amain(args):
+    async with temp_db():
+        names = [f"商品{k:05d}" for k in range(args.products)]
+        async with main.db.write() as conn:
+            await conn.executemany("INSERT INTO products (name, price, current) VALUES (?, 100, 1)", [(n,) for n in names])
+        await main.cache.load()
+
+        guild = loadsim.FakeGuild(); general = main.GeneralPanel()
+        worker = loadsim.FakeMember(1, [guild.get_role(main.OMNIS_ROLE_ID), guild.get_role(main.WORK_ROLE_ID)])
+        sql = []
+        for conn in [main.db.writer, *main.db._readers._queue]: await conn._execute(conn._conn.set_trace_callback, sql.append)
+
+        t = time.perf_counter()
+        for _ in range(args.opens):
+            i = loadsim.FakeInteraction(worker, guild, main.GENERAL_PANEL_CH); await loadsim.click(general, "sale", i)
+        open_ms = (time.perf_counter() - t) / args.opens * 1000
+        view = i.first("message")["view"]
+        sel = next(c for c in view.children if hasattr(c, "options"))
+        check(len(sel.options) == main.PagedPicker.PAGE_SIZE, f"1ページ目の件数 {len(sel.options)}")
+
+        # 1ページ目に無い商品は検索で絞り込んでから選ぶ
+        it = loadsim.FakeInteraction(worker, guild, main.GENERAL_PANEL_CH)
+        await loadsim.pick(view, "商品09999", it)
+        check(it.first("modal") is not None, "検索で絞り込んだ商品を選べない")
+
+        index = main.cache.product_index; k = 100000
+        t = time.perf_counter()
+        for n in range(k): main.prefix_page(index, "商品0", n % 400, 25)
+        page_us = (time.perf_counter() - t) / k * 1e6
+        got, total = main.prefix_page(index, "商品099", 3, 25)
+        check(total == 100 and got == names[9975:10000], f"前方一致の範囲が合わない: {total}")
+        check(not sql, f"ピッカーがSQLを実行した: {sql[:3]}")
+        print(f"{args.products:,} products: open sale picker {open_ms:.2f}ms / prefix_page {page_us:.2f}us")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--products", type=int, default=10000)
+    p.add_argument("--opens", type=int, default=200)
+    asyncio.run(amain(p.parse_args()))
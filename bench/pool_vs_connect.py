@@ -0,0 +1,56 @@
+"""接続プール（user-001）: クリックごとに接続する旧方式と、共有プールの比較
+
+同時クリック（監査行1件の書き込み + 商品一覧の読み取り）を N 件流して所要時間と失敗数を比べる。
+旧方式はロック競合で "database is locked" になるものが出るので、件数として数える。
+あわせて、COMMIT が失敗したあとも書き込み接続がトランザクションに取り残されず使えることを確認する。
+
+    python bench/pool_vs_connect.py [--clicks 400]
+"""
+import argparse
+import asyncio
+
+import aiosqlite
+
+from _common import check, main, temp_db, timed
+
+async def old_click(path, k):
+    # 変更前の各ハンドラと同じく、毎回 connect → 実行 → commit → close
+    async with aiosqlite.connect(path) as d:
+        await d.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)", (k, "bench", "old", 0))
+        await d.commit()
+        await (await d.execute("SELECT name FROM products")).fetchall()
+
+async def pooled_click(k):
+    async with main.db.write() as conn:
+        await conn.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)", (k, "bench", "pool", 0))
+    await main.db.fetchall("SELECT name FROM products")
+
+async def amain(args):
+    async with temp_db() as path:
+        await main.db.close()
+        res, old = await timed(asyncio.gather(*(old_click(path, k) for k in range(args.clicks)), return_exceptions=True))
+        old_err = sum(isinstance(r, Exception) for r in res)
+        await main.db.open()
+        res, pooled = await timed(asyncio.gather(*(pooled_click(k) for k in range(args.clicks)), return_exceptions=True))
+        pool_err = sum(isinstance(r, Exception) for r in res)
+        n = (await main.db.fetchone("SELECT COUNT(*) FROM audit_logs WHERE action='bench' AND detail='pool'"))[0]
+        print(f"{args.clicks} concurrent clicks: connect-per-click {old:.2f}s ({old_err} failed) / pooled {pooled:.2f}s ({pool_err} failed)")
+        check(pool_err == 0 and n == args.clicks, f"プール経由の失敗 {pool_err} 件 / 書き込み {n} 件")
+
+        # 遅延評価の外部キー違反で COMMIT だけを失敗させる
+        await main.db.script("CREATE TABLE bench_fk(x REFERENCES products(name) DEFERRABLE INITIALLY DEFERRED)")
+        try:
+            async with main.db.write() as conn: await conn.execute("INSERT INTO bench_fk VALUES ('missing')")
+            check(False, "COMMIT が失敗しなかった")
+        except aiosqlite.IntegrityError:
+            pass
+        check(not main.db.writer.in_transaction, "COMMIT 失敗後も書き込み接続がトランザクション中")
+        await pooled_click(-1)
+        check((await main.db.fetchone("SELECT COUNT(*) FROM bench_fk"))[0] == 0, "失敗した COMMIT の行が残っている")
+        print("commit failure rolled back, writer reusable")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--clicks", type=int, default=400)
+    asyncio.run(amain(p.parse_args()))
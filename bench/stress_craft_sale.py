@@ -0,0 +1,55 @@
+"""制作・売上のストレステスト（user-002）
+
+在庫が足りなくなる量の制作報告と売上報告を数百件同時に投げ、次を確認する。
+- 在庫が負にならず、成功した報告の合計とぴったり一致する
+- 成功1件につき監査行（制作）・台帳行（売上）がちょうど1件
+- 売上ランキングの合計が成功した売上の金額と一致する
+
+    python bench/stress_craft_sale.py [--reports 600] [--seed 1]
+"""
+import argparse
+import asyncio
+import random
+
+from _common import check, main, temp_db, timed
+
+IRON, WOOD, PRICE = 1000, 500, 100
+
+async def amain(args):
+    rng = random.Random(args.seed)
+    async with temp_db():
+        async with main.db.write() as conn:
+            await conn.executemany("INSERT INTO materials (name, current) VALUES (?,?)", [("iron", IRON), ("wood", WOOD)])
+            await conn.execute("INSERT INTO products (name, price, current) VALUES ('sword', ?, 0)", (PRICE,))
+            await conn.executemany("INSERT INTO recipes VALUES (?,?,?)", [("sword", "iron", 3), ("sword", "wood", 2)])
+        await main.cache.load()
+
+        jobs = [("craft" if k % 2 == 0 else "sale", rng.randint(1, 5)) for k in range(args.reports)]
+        calls = [main.craft_product(1, "sword", q) if kind == "craft" else main.sell_product(2, "sword", q) for kind, q in jobs]
+        results, sec = await timed(asyncio.gather(*calls))
+
+        crafted = sum(q for (kind, q), r in zip(jobs, results) if kind == "craft" and r.ok)
+        sold = sum(q for (kind, q), r in zip(jobs, results) if kind == "sale" and r.ok)
+        n_craft = sum(1 for (kind, _), r in zip(jobs, results) if kind == "craft" and r.ok)
+        n_sale = sum(1 for (kind, _), r in zip(jobs, results) if kind == "sale" and r.ok)
+        rejected = sum(1 for r in results if not r.ok)
+        print(f"{args.reports} concurrent reports in {sec:.2f}s: craft ok {n_craft} ({crafted}個) / sale ok {n_sale} ({sold}個) / rejected {rejected}")
+
+        stock = dict(await main.db.fetchall("SELECT name, current FROM materials UNION ALL SELECT name, current FROM products"))
+        check(stock == {"iron": IRON - 3 * crafted, "wood": WOOD - 2 * crafted, "sword": crafted - sold}, f"在庫が合わない: {stock}")
+        check(min(stock.values()) >= 0, f"在庫が負: {stock}")
+        audit_n = (await main.db.fetchone("SELECT COUNT(*) FROM audit_logs WHERE action='制作'"))[0]
+        ledger_n, ledger_q = await main.db.fetchone("SELECT COUNT(*), COALESCE(SUM(qty), 0) FROM sales")
+        ranking = (await main.db.fetchone("SELECT COALESCE(SUM(total_amount), 0) FROM sales_ranking"))[0]
+        check(audit_n == n_craft, f"制作の監査行 {audit_n} != 成功 {n_craft}")
+        check((ledger_n, ledger_q) == (n_sale, sold), f"売上台帳 {ledger_n}件/{ledger_q}個 != 成功 {n_sale}件/{sold}個")
+        check(ranking == sold * PRICE, f"ランキング {ranking} != {sold * PRICE}")
+        check(rejected > 0, "在庫不足が一度も起きていない（負荷が足りない）")
+        check({m.name: m.current for m in main.cache.materials.values()} == {"iron": stock["iron"], "wood": stock["wood"]}, "キャッシュとDBの不一致")
+        print("OK")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--reports", type=int, default=600)
+    p.add_argument("--seed", type=int, default=1)
+    asyncio.run(amain(p.parse_args()))
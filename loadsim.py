@@ -0,0 +1,266 @@
+"""オフライン負荷シミュレーター
+
+Discordに接続せずに main.py のパネルを読み込み、偽の Interaction / Member / Guild / Role で
+出退勤・制作・売上・集計の混合ワークロードを一時SQLiteファイルに対して流す。
+ハンドラ単位の p50/p95/p99、スループット、DB不変条件の違反数を表示する。
+
+    python loadsim.py --ops 2000 --concurrency 32 --mix shift=1,craft=3,sale=3,stats=1
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import main
+
+# ================= 1. Discord の代役 =================
+_ids = itertools.count(10**17)
+
+class FakeRole:
+    def __init__(self, rid, name=""):
+        self.id = rid; self.name = name or str(rid)
+
+class FakeMember:
+    def __init__(self, uid, roles=()):
+        self.id = uid; self.display_name = f"user{uid}"; self.roles = list(roles)
+        self.role_calls = 0
+
+    async def add_roles(self, *roles, atomic=True, reason=None):
+        self.role_calls += 1
+        for r in roles:
+            if r and all(x.id != r.id for x in self.roles): self.roles.append(r)
+
+    async def remove_roles(self, *roles, atomic=True, reason=None):
+        self.role_calls += 1
+        drop = {r.id for r in roles if r}
+        self.roles = [x for x in self.roles if x.id not in drop]
+
+class FakeGuild:
+    def __init__(self):
+        self.id = next(_ids); self.members = {}
+        self.roles = {rid: FakeRole(rid, name) for name, rid in main.ROLE_OPTIONS.items()}
+        self.roles.setdefault(main.WORK_ROLE_ID, FakeRole(main.WORK_ROLE_ID, "出勤中"))
+
+    def get_role(self, rid): return self.roles.get(rid)
+    def get_member(self, uid): return self.members.get(uid)
+
+class FakeResponse:
+    """InteractionResponse の記録係。最初の応答だけを受け付ける点も本物と同じ。"""
+    def __init__(self, it):
+        self._it = it; self._done = False
+
+    def is_done(self): return self._done
+
+    def _ack(self, kind, **kw):
+        if self._done: raise RuntimeError("interaction already responded")
+        self._done = True; self._it.sent.append((kind, kw))
+
+    async def send_message(self, content=None, **kw): self._ack("message", content=content, **kw)
+    async def send_modal(self, modal): self._ack("modal", modal=modal)
+    async def edit_message(self, **kw): self._ack("edit", **kw)
+    async def defer(self, **kw): self._ack("defer", **kw)
+
+class FakeFollowup:
+    def __init__(self, it): self._it = it
+    async def send(self, content=None, **kw): self._it.sent.append(("followup", {"content": content, **kw}))
+
+class FakeInteraction:
+    def __init__(self, user, guild, channel_id):
+        self.id = next(_ids); self.user = user; self.guild = guild; self.channel_id = channel_id
+        self.sent = []
+        self.response = FakeResponse(self); self.followup = FakeFollowup(self)
+
+    async def edit_original_response(self, **kw): self.sent.append(("edit_original", kw))
+
+    def first(self, kind):
+        return next((kw for k, kw in self.sent if k == kind), None)
+
+    @property
+    def text(self):
+        return " / ".join(str(kw.get("content") or "") for k, kw in self.sent if k in ("message", "followup", "edit", "edit_original"))
+
+# ================= 2. 操作の再生 =================
+async def click(view, name, it):
+    """View._scheduled_task と同じ順序で interaction_check → コールバックを呼ぶ。"""
+    if not await view.interaction_check(it): return
+    await getattr(view, name).callback(it)
+
+async def pick(view, value, it):
+    """セレクトから value を選ぶ。表示中のページに無ければ、利用者と同じく検索ボタンで絞り込んでから選ぶ。"""
+    sel = next(c for c in view.children if hasattr(c, "options"))
+    if all(o.value != value for o in sel.options):
+        search = next(c for c in view.children if getattr(c, "label", None) == "🔍 検索")
+        it_s = FakeInteraction(it.user, it.guild, it.channel_id); await search.callback(it_s)
+        await submit(it_s.first("modal")["modal"], value, FakeInteraction(it.user, it.guild, it.channel_id))
+    sel._values = [value]          # discord.py が受信データから設定する値を直接入れる
+    await sel.callback(it)
+
+async def submit(modal, text, it):
+    modal.input._value = text
+    await modal.on_submit(it)
+
+class Simulator:
+    def __init__(self, args):
+        self.args = args; self.rng = random.Random(args.seed)
+        self.guild = FakeGuild()
+        self.admin_panel = main.AdminPanel(); self.general = main.GeneralPanel()
+        self.lat = {}                   # シナリオ名 -> [秒, ...]
+        self.crafted = {}; self.sold = {}
+        self.rejected = 0; self.errors = []
+        omnis, work, admin = (self.guild.get_role(r) for r in (main.OMNIS_ROLE_ID, main.WORK_ROLE_ID, main.ADMIN_ROLE_ID))
+        # 出退勤を繰り返すメンバーと、常に出勤中で制作・売上を行うメンバーを分ける
+        self.shifters = [self._member(omnis) for _ in range(args.users)]
+        self.workers = [self._member(omnis, work) for _ in range(args.users)]
+        self.admin = self._member(admin)
+
+    def _member(self, *roles):
+        m = FakeMember(next(_ids), roles); self.guild.members[m.id] = m
+        return m
+
+    def interaction(self, user, channel_id=main.GENERAL_PANEL_CH):
+        return FakeInteraction(user, self.guild, channel_id)
+
+    async def seed(self):
+        a = self.args
+        async with main.db.write() as conn:
+            await conn.executemany("INSERT INTO materials (name, current) VALUES (?, ?)",
+                                   ((f"素材{k:03d}", a.stock) for k in range(a.materials)))
+            await conn.executemany("INSERT INTO products (name, price, current) VALUES (?, ?, ?)",
+                                   ((f"商品{k:03d}", 100 + k, a.stock // 10) for k in range(a.products)))
+            rows = []
+            for k in range(a.products):
+                for m in self.rng.sample(range(a.materials), min(3, a.materials)): rows.append((f"商品{k:03d}", f"素材{m:03d}", self.rng.randint(1, 3)))
+            await conn.executemany("INSERT INTO recipes VALUES (?,?,?)", rows)
+        await main.cache.load()
+        self.initial = ({n: m.current for n, m in main.cache.materials.items()},
+                        {n: p.current for n, p in main.cache.products.items()},
+                        {n: dict(r) for n, r in main.cache.recipes.items()})
+
+    # --- シナリオ ---
+    async def op_shift(self):
+        it = self.interaction(self.rng.choice(self.shifters))
+        await click(self.general, "work", it)
+
+    async def _report(self, button, counter):
+        user = self.rng.choice(self.workers); product = self.rng.choice(main.cache.product_index)
+        it = self.interaction(user); await click(self.general, button, it)
+        view = (it.first("message") or {}).get("view")
+        if not view: self.rejected += 1; return
+        it2 = self.interaction(user); await pick(view, product, it2)
+        it3 = self.interaction(user); qty = self.rng.randint(1, 3)
+        await submit(it2.first("modal")["modal"], str(qty), it3)
+        if it3.text.startswith(("✅", "💰")): counter[product] = counter.get(product, 0) + qty
+        else: self.rejected += 1
+
+    async def op_craft(self): await self._report("craft", self.crafted)
+    async def op_sale(self): await self._report("sale", self.sold)
+
+    async def op_stats(self):
+        it = self.interaction(self.admin, main.ADMIN_PANEL_CH)
+        await click(self.admin_panel, "stats", it)
+        view = it.first("message")["view"]
+        if not view.next_btn.disabled: await view.next_btn.callback(self.interaction(self.admin, main.ADMIN_PANEL_CH))
+
+    async def run(self):
+        mix = [(name, int(w)) for name, w in (p.split("=") for p in self.args.mix.split(","))]
+        plan = self.rng.choices([n for n, _ in mix], weights=[w for _, w in mix], k=self.args.ops)
+        sem = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(name):
+            async with sem:
+                t = time.perf_counter()
+                try: await getattr(self, f"op_{name}")()
+                except Exception as e: self.errors.append(f"{name}: {e!r}")
+                self.lat.setdefault(name, []).append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        await asyncio.gather(*(one(n) for n in plan))
+        return time.perf_counter() - t
+
+    # --- 不変条件 ---
+    async def check(self):
+        bad = []
+        mats0, prods0, recipes = self.initial
+        for n, m in main.cache.materials.items():
+            want = mats0[n] - sum(q * recipes.get(p, {}).get(n, 0) for p, q in self.crafted.items())
+            if m.current != want: bad.append(f"素材 {n}: キャッシュ {m.current} / 期待 {want}")
+        for n, p in main.cache.products.items():
+            want = prods0[n] + self.crafted.get(n, 0) - self.sold.get(n, 0)
+            if p.current != want: bad.append(f"商品 {n}: キャッシュ {p.current} / 期待 {want}")
+        for n, cur in await main.db.fetchall("SELECT name, current FROM materials UNION ALL SELECT name, current FROM products"):
+            if cur < 0: bad.append(f"在庫が負: {n}={cur}")
+            c = main.cache.materials.get(n) or main.cache.products.get(n)
+            if c and c.current != cur: bad.append(f"DBとキャッシュの不一致: {n} DB={cur} cache={c.current}")
+        open_dup = await main.db.fetchone("SELECT COUNT(*) FROM (SELECT user_id FROM work_logs WHERE end IS NULL GROUP BY user_id HAVING COUNT(*) > 1)")
+        if open_dup[0]: bad.append(f"出勤中が重複しているユーザー: {open_dup[0]}")
+        on_duty = {r[0] for r in await main.db.fetchall("SELECT user_id FROM work_logs WHERE end IS NULL")}
+        for m in self.shifters:
+            if any(r.id == main.WORK_ROLE_ID for r in m.roles) != (m.id in on_duty): bad.append(f"勤務中ロールと勤怠の不一致: {m.id}")
+        ranking = (await main.db.fetchone("SELECT COALESCE(SUM(total_amount), 0) FROM sales_ranking"))[0]
+        totals = await main.db.fetchone("SELECT COALESCE(SUM(sales_amount), 0), COALESCE(SUM(work_minutes), 0) FROM user_totals WHERE bucket='all'")
+        worked = (await main.db.fetchone("SELECT COALESCE(SUM(duration), 0) FROM work_logs WHERE end IS NOT NULL"))[0]
+        if ranking != totals[0]: bad.append(f"売上累計の不一致: ranking={ranking} totals={totals[0]}")
+        if worked != totals[1]: bad.append(f"勤怠累計の不一致: logs={worked} totals={totals[1]}")
+        drift = await main.db.fetchone("SELECT COUNT(*) FROM (SELECT user_id, SUM(qty * unit_price) AS amt FROM sales GROUP BY user_id) l "
+                                       "LEFT JOIN sales_ranking r USING(user_id) WHERE r.total_amount IS NOT l.amt")
+        if drift[0]: bad.append(f"売上台帳とランキングの不一致: {drift[0]}人")
+        daily = await main.db.fetchone("SELECT (SELECT COALESCE(SUM(minutes), 0) FROM daily_work), (SELECT COALESCE(SUM(amount), 0) FROM daily_sales)")
+        if daily != (worked, ranking): bad.append(f"日次集計の不一致: daily={tuple(daily)} 期待={(worked, ranking)}")
+        expect_amt = sum(main.cache.products[n].price * q for n, q in self.sold.items())
+        if ranking != expect_amt: bad.append(f"売上金額の不一致: DB={ranking} 期待={expect_amt}")
+        return bad
+
+# ================= 3. 集計・出力 =================
+def pct(xs, q):
+    xs = sorted(xs); return xs[min(len(xs) - 1, int(len(xs) * q))] * 1000 if xs else 0.0
+
+def report(sim, elapsed, bad):
+    allx = [x for xs in sim.lat.values() for x in xs]
+    print(f"ops={len(allx)} concurrency={sim.args.concurrency} elapsed={elapsed:.2f}s throughput={len(allx) / elapsed:.0f} ops/s")
+    print(f"{'scenario':<8} {'n':>6} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'maxms':>8}")
+    for name, xs in sorted(sim.lat.items()) + [("ALL", allx)]:
+        print(f"{name:<8} {len(xs):>6} {pct(xs, .5):>8.2f} {pct(xs, .95):>8.2f} {pct(xs, .99):>8.2f} {max(xs) * 1000:>8.2f}")
+    print(f"role edits={sum(m.role_calls for m in sim.shifters + sim.workers)} ({main.role_sync.stats()})")
+    print(f"rejected (在庫不足など)={sim.rejected} errors={len(sim.errors)} invariant violations={len(bad)}")
+    for line in (sim.errors[:5] + bad[:20]): print("  -", line)
+    if sim.args.handlers: print(main.perf.report(top=30))
+
+async def amain(args):
+    workdir = tempfile.mkdtemp(prefix="omnis_sim_")
+    main.db.path = args.db or os.path.join(workdir, "sim.db")
+    main.AUDIT_ARCHIVE_DIR = os.path.join(workdir, "audit_archive")
+    main.PERF_SAMPLE_RATE = 1.0
+    try:
+        await main.init_db()
+        sim = Simulator(args)
+        await sim.seed()
+        elapsed = await sim.run()
+        await asyncio.gather(main.audit.drain(), main.role_sync.drain())
+        bad = await sim.check()
+        report(sim, elapsed, bad)
+        return 1 if bad or sim.errors else 0
+    finally:
+        await main.audit.drain()
+        await main.db.close()
+        if not args.db: shutil.rmtree(workdir, ignore_errors=True)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="オフライン負荷シミュレーター")
+    p.add_argument("--ops", type=int, default=2000, help="実行する操作の総数")
+    p.add_argument("--concurrency", type=int, default=32, help="同時に進行する操作の数")
+    p.add_argument("--mix", default="shift=1,craft=3,sale=3,stats=1", help="シナリオの重み (shift/craft/sale/stats)")
+    p.add_argument("--users", type=int, default=40, help="出退勤役・制作販売役それぞれの人数")
+    p.add_argument("--products", type=int, default=60)
+    p.add_argument("--materials", type=int, default=30)
+    p.add_argument("--stock", type=int, default=5000, help="素材の初期在庫（商品はその1/10）")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--db", help="使用するDBファイル（省略時は一時ファイルを作って後で消す）")
+    p.add_argument("--handlers", action="store_true", help="ハンドラ単位の性能レポートも表示する")
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(amain(parse_args())))
@@ -1,9 +1,27 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import aiosqlite
-from datetime import datetime
+import asyncio
+import bisect
+from collections import deque
+from contextlib import asynccontextmanager
+import contextvars
+from datetime import datetime, timedelta
+import csv
+import gzip
+import hashlib
+import io
+import json
+import tempfile
+from typing import NamedTuple
 import os
+import random
+import re
+import struct
 import sys
+import time
+import unicodedata
+import zlib
 from dotenv import load_dotenv
 
 # ================= 1. 設定セクション =================
@@ -31,140 +49,1633 @@ ROLE_OPTIONS = {
     "アルバイトロール": 1455243576337502228
 }
 
-DB_PATH = "omnis_system_v15.db"
+DB_PATH = "omnis_system_v15.db"   # スキーマ変更はMIGRATIONSに追加する（ファイル名はもう変えない）
+DB_READERS = 4   # 読み取り専用コネクション数（書き込みは常に1本）
+
+# 監査ログ（キューに溜めてまとめて書き込む）
+AUDIT_BATCH_SIZE = 100        # この件数が溜まったら即書き込み
+AUDIT_FLUSH_SEC = 2.0         # 最初の1件からこの秒数で書き込み
+AUDIT_RETENTION_DAYS = 90     # これより古い行はアーカイブへ移す
+AUDIT_ARCHIVE_DIR = "audit_archive"
+AUDIT_DRAIN_RETRIES = 3       # 停止時に書き込みが失敗し続けたら、この回数でファイルへ退避する
+
+# 在庫ダッシュボード（ITEM_PANEL_CH のメッセージをその場で書き換える）
+DASHBOARD_INTERVAL = 10       # 再描画は最短でもこの秒数に1回
+
+# 応答時間の計測
+PERF_RING_SIZE = 2000         # 直近の詳細サンプルを保持する件数
+PERF_SAMPLE_RATE = 0.5        # 詳細サンプルを記録する割合（ヒストグラムは全件）
+PERF_DEFER_AFTER = 2.0        # この秒数までに応答していなければ自動でdeferする（期限は3秒）
+PERF_PROM_FILE = os.getenv("PERF_PROM_FILE")   # 設定時のみ Prometheus 形式で定期書き出し
+
+# ロール付与・剥奪（応答とは切り離してワーカーがまとめて反映する）
+ROLE_SYNC_DELAY = 1.5         # 要求からこの秒数待ってから反映（その間の出退勤の往復は相殺される）
+ROLE_SYNC_RETRIES = 5         # 429・5xx のときの再試行回数
+
+# 全コネクション共通のPRAGMA（journal_mode=WALはファイルに永続化される）
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",     # WAL下ではNORMALでもコミット済みデータは失われない
+    "PRAGMA cache_size=-16000",      # 約16MBのページキャッシュ
+    "PRAGMA mmap_size=268435456",    # 256MBまでmmapで読む
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA journal_size_limit=67108864",   # チェックポイント後のWALは64MBまで切り詰める
+)
+
+# ================= 2. データベース接続層 =================
+class Database:
+    """書き込み1本 + 読み取り複数のコネクションプール。
+    接続は起動時に一度だけ開き、各ハンドラは write() / read() 経由で使い回す。"""
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path; self.n_readers = readers
+        self.writer = None; self._readers = None
+        self._wlock = asyncio.Lock()
+
+    @property
+    def is_open(self): return self.writer is not None
+
+    async def _connect(self, readonly=False):
+        # isolation_level=None: トランザクションはwrite()が明示的にBEGIN/COMMITする
+        # cached_statements: 同じSQL文字列のプリペアドステートメントを接続ごとに再利用
+        conn = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=256)
+        for p in DB_PRAGMAS: await conn.execute(p)
+        if readonly: await conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    async def open(self):
+        if self.is_open: return
+        self.writer = await self._connect()   # 先にwriterを開いてWALへ切り替える
+        self._readers = asyncio.Queue()
+        for _ in range(self.n_readers): self._readers.put_nowait(await self._connect(readonly=True))
+
+    async def close(self):
+        if not self.is_open: return
+        async with self._wlock:
+            while not self._readers.empty(): await self._readers.get_nowait().close()
+            await self.writer.execute("PRAGMA optimize")
+            await self.writer.close()
+            self.writer = None; self._readers = None
+
+    @asynccontextmanager
+    async def write(self):
+        """書き込みトランザクション。正常終了でCOMMIT、例外でROLLBACK。"""
+        t = time.perf_counter()
+        async with self._wlock:
+            await self.writer.execute("BEGIN IMMEDIATE")
+            perf.add_sql(time.perf_counter() - t, 0)   # ロック待ちもDB時間として数える
+            try:
+                yield _TimedConn(self.writer)
+            except BaseException:
+                await self.writer.execute("ROLLBACK"); raise
+            else:
+                t = time.perf_counter()
+                try: await self.writer.execute("COMMIT")
+                except BaseException:
+                    # COMMIT が失敗（BUSY・I/O など）しても接続はトランザクション中のまま残るので、閉じてから投げ直す
+                    if self.writer.in_transaction: await self.writer.execute("ROLLBACK")
+                    raise
+                perf.add_sql(time.perf_counter() - t, 0)
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._readers.get()
+        try: yield _TimedConn(conn)
+        finally: self._readers.put_nowait(conn)
+
+    async def script(self, sql):
+        """スキーマ定義など複数文のスクリプトを実行（executescriptは自前でCOMMITする）。"""
+        async with self._wlock: await self.writer.executescript(sql)
+
+    async def fetchall(self, sql, params=()):
+        t = time.perf_counter(); conn = await self._readers.get()
+        try: return await (await conn.execute(sql, params)).fetchall()
+        finally: self._readers.put_nowait(conn); perf.add_sql(time.perf_counter() - t)
+
+    async def fetchone(self, sql, params=()):
+        t = time.perf_counter(); conn = await self._readers.get()
+        try: return await (await conn.execute(sql, params)).fetchone()
+        finally: self._readers.put_nowait(conn); perf.add_sql(time.perf_counter() - t)
+
+class _TimedConn:
+    """write() / read() が渡すコネクションの薄いラッパー。execute系の所要時間と回数を計測に回す。"""
+    __slots__ = ("_conn",)
+    def __init__(self, conn): self._conn = conn
+    def __getattr__(self, name): return getattr(self._conn, name)
+
+    async def execute(self, sql, params=()):
+        t = time.perf_counter()
+        try: return await self._conn.execute(sql, params)
+        finally: perf.add_sql(time.perf_counter() - t)
+
+    async def executemany(self, sql, seq):
+        t = time.perf_counter()
+        try: return await self._conn.executemany(sql, seq)
+        finally: perf.add_sql(time.perf_counter() - t)
+
+db = Database(DB_PATH)
+
+class OmnisBot(commands.Bot):
+    async def setup_hook(self):
+        # ログイン時に1プロセス1回だけ走る（再接続のたびに走る on_ready とは別）
+        await startup()
+
+    async def close(self):
+        # 停止時に監査ログキューを書き切ってからプールを閉じ、WALをチェックポイントさせる
+        await asyncio.gather(audit.drain(), role_sync.drain())
+        await db.close()
+        await super().close()
+
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = OmnisBot(command_prefix="!", intents=intents)
+
+# ================= 2.5. データベース初期化・マイグレーション =================
+# v15時点のスキーマ（既存DBではすべてIF NOT EXISTSで素通りする）
+_BASE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS work_logs(user_id INTEGER, start DATETIME, end DATETIME, duration INTEGER DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS materials(name TEXT PRIMARY KEY, current INTEGER DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS products(name TEXT PRIMARY KEY, price INTEGER DEFAULT 0, current INTEGER DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS recipes(product_name TEXT, material_name TEXT, quantity INTEGER, PRIMARY KEY(product_name, material_name))",
+    "CREATE TABLE IF NOT EXISTS sales_ranking(user_id INTEGER PRIMARY KEY, total_amount INTEGER DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS audit_logs(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, detail TEXT, created_at DATETIME)",
+)
+
+def to_epoch(v):
+    """旧形式の str(datetime)（マイクロ秒の有無を問わない）をUNIX秒に変換する。"""
+    if v is None or isinstance(v, int): return v
+    return int(datetime.fromisoformat(v).timestamp())
+
+async def _m001_base(conn):
+    for stmt in _BASE_SCHEMA: await conn.execute(stmt)
+
+async def _m002_epoch_and_indexes(conn):
+    # work_logs: 主キー追加 + start/end をUNIX秒(INTEGER)へ
+    rows = await (await conn.execute("SELECT user_id, start, end, duration FROM work_logs")).fetchall()
+    await conn.execute("DROP TABLE work_logs")
+    await conn.execute("CREATE TABLE work_logs(id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, start INTEGER NOT NULL, end INTEGER, duration INTEGER DEFAULT 0)")
+    await conn.executemany("INSERT INTO work_logs (user_id, start, end, duration) VALUES (?,?,?,?)",
+                           ((u, to_epoch(s), to_epoch(e), d or 0) for u, s, e, d in rows))
+
+    # audit_logs: created_at をUNIX秒へ（idは維持）
+    rows = await (await conn.execute("SELECT id, user_id, action, detail, created_at FROM audit_logs")).fetchall()
+    await conn.execute("DROP TABLE audit_logs")
+    await conn.execute("CREATE TABLE audit_logs(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, detail TEXT, created_at INTEGER NOT NULL)")
+    await conn.executemany("INSERT INTO audit_logs VALUES (?,?,?,?,?)",
+                           ((n, u, a, d, to_epoch(c)) for n, u, a, d, c in rows))
+
+    # recipes: 商品・素材への外部キー（削除時はレシピ行も連動して消える）。孤立行は移行しない
+    await conn.execute("ALTER TABLE recipes RENAME TO recipes_old")
+    await conn.execute("""CREATE TABLE recipes(
+        product_name TEXT NOT NULL REFERENCES products(name) ON DELETE CASCADE ON UPDATE CASCADE,
+        material_name TEXT NOT NULL REFERENCES materials(name) ON DELETE CASCADE ON UPDATE CASCADE,
+        quantity INTEGER NOT NULL, PRIMARY KEY(product_name, material_name))""")
+    await conn.execute("""INSERT INTO recipes SELECT r.product_name, r.material_name, r.quantity FROM recipes_old r
+        WHERE r.product_name IN (SELECT name FROM products) AND r.material_name IN (SELECT name FROM materials)""")
+    await conn.execute("DROP TABLE recipes_old")
+
+    # 旧版は確認と挿入が別接続だったので、二重クリックで出勤中の行が重複していることがある。
+    # 各ユーザーの最新の1行だけを出勤中として残し、それより前の行は長さ0の勤務として閉じる
+    cur = await conn.execute("""UPDATE work_logs SET end = start, duration = 0 WHERE id IN (
+        SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY start DESC, id DESC) AS rn
+                        FROM work_logs WHERE end IS NULL) WHERE rn > 1)""")
+    if cur.rowcount: print(f"work_logs: closed {cur.rowcount} duplicate open shifts")
+
+    # 出勤中の行は1人1行だけ（部分インデックス兼一意制約）
+    await conn.execute("CREATE UNIQUE INDEX idx_work_open ON work_logs(user_id) WHERE end IS NULL")
+    await conn.execute("CREATE INDEX idx_work_user_start ON work_logs(user_id, start, duration)")   # 集計用にdurationまで含めてカバリング
+    await conn.execute("CREATE INDEX idx_audit_created ON audit_logs(created_at)")
+    await conn.execute("CREATE INDEX idx_recipes_material ON recipes(material_name)")
+
+async def _m003_user_totals(conn):
+    # bucket: "all" / "d:YYYY-MM-DD" / "w:YYYY-Www" / "m:YYYY-MM"
+    await conn.execute("""CREATE TABLE user_totals(bucket TEXT NOT NULL, user_id INTEGER NOT NULL,
+        work_minutes INTEGER NOT NULL DEFAULT 0, sales_amount INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(bucket, user_id))""")
+    # 上位N件をソートなしで取り出すための順序付きインデックス
+    await conn.execute("CREATE INDEX idx_totals_sales ON user_totals(bucket, sales_amount DESC)")
+    await conn.execute("CREATE INDEX idx_totals_work ON user_totals(bucket, work_minutes DESC)")
+    # 既存データから埋める。勤怠はバケットごとに1文で集計し、売上は監査ログの文面（created_at付き）から日・週・月を復元する。
+    # 全期間の売上はアーカイブ・リセット済みの分も含むランキングの値を正とする
+    for kind in TOTAL_BUCKETS:
+        await conn.execute(f"""INSERT INTO user_totals (bucket, user_id, work_minutes)
+            SELECT {bucket_sql(kind, 'end')}, user_id, SUM(COALESCE(duration, 0)) FROM work_logs WHERE end IS NOT NULL GROUP BY 1, 2""")
+    sales = {}
+    for uid, detail, ts in await (await conn.execute("SELECT user_id, detail, created_at FROM audit_logs WHERE action='売上'")).fetchall():
+        if (m := SALE_DETAIL_RE.match(detail or "")):
+            for kind in ("d", "w", "m"):
+                k = (bucket_key(kind, ts), uid); sales[k] = sales.get(k, 0) + int(m[3].replace(",", ""))
+    await conn.executemany(_SQL_BUMP_TOTALS, [(b, uid, 0, amt) for (b, uid), amt in sales.items()])
+    await conn.execute("INSERT INTO user_totals (bucket, user_id, sales_amount) SELECT 'all', user_id, total_amount FROM sales_ranking WHERE true "
+                       "ON CONFLICT(bucket, user_id) DO UPDATE SET sales_amount = excluded.sales_amount")
+
+async def _m004_panel_messages(conn):
+    # 常設パネル・ダッシュボードのメッセージID（起動時に送り直さず再利用する）
+    await conn.execute("""CREATE TABLE panel_messages(key TEXT PRIMARY KEY, channel_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL, layout_hash TEXT)""")
+
+async def _m005_daily_rollups(conn):
+    # 日付(ローカル時刻の YYYY-MM-DD)ごとの集計。期間集計は行数ではなく日数に比例する
+    await conn.execute("""CREATE TABLE daily_work(day TEXT NOT NULL, user_id INTEGER NOT NULL,
+        minutes INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(day, user_id)) WITHOUT ROWID""")
+    await conn.execute("""CREATE TABLE daily_sales(day TEXT NOT NULL, user_id INTEGER NOT NULL, product TEXT NOT NULL,
+        qty INTEGER NOT NULL DEFAULT 0, amount INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(day, user_id, product)) WITHOUT ROWID""")
+    # 期間締め（user_id が NULL なら全体）。day 以降が新しい期間
+    await conn.execute("""CREATE TABLE period_closes(id INTEGER PRIMARY KEY, user_id INTEGER, day TEXT NOT NULL,
+        closed_by INTEGER, closed_at INTEGER NOT NULL)""")
+    await conn.execute("CREATE INDEX idx_period_closes ON period_closes(user_id, day)")
+    # 既存データから埋める。勤怠は日をまたいだ分を各日に割り振り、売上は監査ログの文面から復元する（アーカイブ済みの分は対象外）
+    # 行ごとにUPSERTせず、メモリ上で (日, ユーザー[, 商品]) に畳んでから1回の executemany で書く
+    work = {}
+    for uid, start, end in await (await conn.execute("SELECT user_id, start, end FROM work_logs WHERE end IS NOT NULL")).fetchall():
+        for d, m in split_days(start, end): work[(d, uid)] = work.get((d, uid), 0) + m
+    await conn.executemany("INSERT INTO daily_work (day, user_id, minutes) VALUES (?,?,?)", [(d, u, m) for (d, u), m in work.items()])
+    sales = {}
+    for uid, detail, ts in await (await conn.execute("SELECT user_id, detail, created_at FROM audit_logs WHERE action='売上'")).fetchall():
+        if (m := SALE_DETAIL_RE.match(detail or "")):
+            t = sales.setdefault((day_key(ts), uid, m[1]), [0, 0]); t[0] += int(m[2]); t[1] += int(m[3].replace(",", ""))
+    await conn.executemany("INSERT INTO daily_sales (day, user_id, product, qty, amount) VALUES (?,?,?,?,?)",
+                           [(d, u, p, q, a) for (d, u, p), (q, a) in sales.items()])
+
+async def _m006_sales_ledger(conn):
+    # 売上台帳（追記のみ）。金額は qty * unit_price。取消は qty を負にした行を ref 付きで足す
+    await conn.execute("""CREATE TABLE sales(id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, product TEXT NOT NULL,
+        qty INTEGER NOT NULL, unit_price INTEGER NOT NULL, ts INTEGER NOT NULL,
+        kind TEXT NOT NULL DEFAULT 'sale', ref INTEGER REFERENCES sales(id))""")
+    # 期間・ユーザー・商品ごとの集計が表を引かずに済むよう、金額計算に要る列まで含める
+    await conn.execute("CREATE INDEX idx_sales_ts ON sales(ts, user_id, product, qty, unit_price)")
+    await conn.execute("CREATE INDEX idx_sales_user ON sales(user_id, ts, qty, unit_price)")
+    await conn.execute("CREATE INDEX idx_sales_product ON sales(product, ts, qty, unit_price)")
+    await conn.execute("CREATE UNIQUE INDEX idx_sales_void ON sales(ref) WHERE ref IS NOT NULL")   # 二重取消の防止
+    # 台帳から派生させる集計表ごとの反映済み位置
+    await conn.execute("CREATE TABLE projections(name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)")
+
+    # 監査ログの文面から復元する。アーカイブ済み・リセット済みの分はランキングと合わないので、差額を調整行で残す
+    rows = []
+    for uid, detail, ts in await (await conn.execute("SELECT user_id, detail, created_at FROM audit_logs WHERE action='売上' ORDER BY id")).fetchall():
+        if (m := SALE_DETAIL_RE.match(detail or "")) and int(m[2]) > 0:
+            qty = int(m[2]); rows.append((uid, m[1], qty, int(m[3].replace(",", "")) // qty, ts))
+    await conn.executemany("INSERT INTO sales (user_id, product, qty, unit_price, ts) VALUES (?,?,?,?,?)", rows)
+    ledger = dict(await (await conn.execute("SELECT user_id, SUM(qty * unit_price) FROM sales GROUP BY user_id")).fetchall())
+    ranking = dict(await (await conn.execute("SELECT user_id, total_amount FROM sales_ranking")).fetchall())
+    now = int(time.time())
+    await conn.executemany("INSERT INTO sales (user_id, product, qty, unit_price, ts, kind) VALUES (?, '(移行調整)', 1, ?, ?, 'adjust')",
+                           [(u, ranking.get(u, 0) - ledger.get(u, 0), now) for u in ranking.keys() | ledger.keys() if ranking.get(u, 0) != ledger.get(u, 0)])
+    # 既存の集計表は移行済みの値をそのまま使い、以降の行だけを射影する
+    await conn.execute("INSERT INTO projections SELECT 'sales', COALESCE(MAX(id), 0) FROM sales")
+
+async def _m007_recipe_parts(conn):
+    # 中間商品を材料にするレシピ（recipes.material_name は素材への外部キーなので別表にする）
+    await conn.execute("""CREATE TABLE recipe_parts(
+        product_name TEXT NOT NULL REFERENCES products(name) ON DELETE CASCADE ON UPDATE CASCADE,
+        part_name TEXT NOT NULL REFERENCES products(name) ON DELETE CASCADE ON UPDATE CASCADE,
+        quantity INTEGER NOT NULL, PRIMARY KEY(product_name, part_name), CHECK(product_name <> part_name))""")
+    await conn.execute("CREATE INDEX idx_recipe_parts_part ON recipe_parts(part_name)")
+
+# (バージョン, 適用関数) を昇順で並べる。適用済みの番号は絶対に書き換えないこと
+MIGRATIONS = (
+    (1, _m001_base),
+    (2, _m002_epoch_and_indexes),
+    (3, _m003_user_totals),
+    (4, _m004_panel_messages),
+    (5, _m005_daily_rollups),
+    (6, _m006_sales_ledger),
+    (7, _m007_recipe_parts),
+)
+
+async def migrate():
+    await db.script("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY KEY, applied_at INTEGER NOT NULL)")
+    current = (await db.fetchone("SELECT COALESCE(MAX(version), 0) FROM schema_version"))[0]
+    for version, step in MIGRATIONS:
+        if version <= current: continue
+        # 1マイグレーション = 1トランザクション。途中で失敗すれば丸ごと巻き戻る
+        t = time.perf_counter()
+        async with db.write() as conn:
+            await step(conn)
+            await conn.execute("INSERT INTO schema_version VALUES (?,?)", (version, int(time.time())))
+        print(f"DB migrated to v{version} ({time.perf_counter() - t:.2f}s)")
 
-# ================= 2. データベース初期化 =================
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript("""
-        CREATE TABLE IF NOT EXISTS work_logs(user_id INTEGER, start DATETIME, end DATETIME, duration INTEGER DEFAULT 0);
-        CREATE TABLE IF NOT EXISTS materials(name TEXT PRIMARY KEY, current INTEGER DEFAULT 0);
-        CREATE TABLE IF NOT EXISTS products(name TEXT PRIMARY KEY, price INTEGER DEFAULT 0, current INTEGER DEFAULT 0);
-        CREATE TABLE IF NOT EXISTS recipes(product_name TEXT, material_name TEXT, quantity INTEGER, PRIMARY KEY(product_name, material_name));
-        CREATE TABLE IF NOT EXISTS sales_ranking(user_id INTEGER PRIMARY KEY, total_amount INTEGER DEFAULT 0);
-        CREATE TABLE IF NOT EXISTS audit_logs(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT, detail TEXT, created_at DATETIME);
-        """)
-        await db.commit()
-
-async def add_audit(user_id, action, detail):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)",
-                        (user_id, action, detail, datetime.now()))
-        await db.commit()
+    await db.open()
+    await migrate()
+
+
+# ================= 2.6. マスタデータキャッシュ =================
+class Product:
+    __slots__ = ("name", "price", "current", "version")
+    def __init__(self, name, price=0, current=0):
+        self.name = name; self.price = price; self.current = current; self.version = 0
+
+class Material:
+    __slots__ = ("name", "current")
+    def __init__(self, name, current=0):
+        self.name = name; self.current = current
+
+CRAFT_MAX = 10**6   # 素材を使わないレシピなどで「作れる数」が決まらないときの上限
+
+def find_cycle(parts):
+    """{商品: {中間商品: 数}} に循環があればその経路（先頭と末尾が同じ名前）を、なければ None を返す。"""
+    state = {}   # 1 = 探索中, 2 = 探索済み
+    for root in parts:
+        if state.get(root): continue
+        state[root] = 1; path = [root]; stack = [iter(parts.get(root, ()))]
+        while stack:
+            nxt = next(stack[-1], None)
+            if nxt is None:
+                state[path.pop()] = 2; stack.pop(); continue
+            if state.get(nxt) == 1: return path[path.index(nxt):] + [nxt]
+            if not state.get(nxt):
+                state[nxt] = 1; path.append(nxt); stack.append(iter(parts.get(nxt, ())))
+    return None
+
+class MasterCache:
+    """商品・素材・レシピのメモリ常駐コピー。起動時に1回読み込み、以後はDBコミット後に書き込み側から更新する。
+    読み取り専用のパネル操作はここだけを参照し、SQLを発行しない。
+    レシピは中間商品を含むDAGで、商品ごとの「今作れる最大数」は在庫・レシピが変わった商品（とその上位）だけ読み出し時に再計算する。"""
+    def __init__(self):
+        self.products = {}     # 名前 -> Product
+        self.materials = {}    # 名前 -> Material
+        self.recipes = {}      # 商品名 -> {素材名: 1個あたりの数}
+        self.used_in = {}      # 素材名 -> {商品名, ...}（レシピの逆引き）
+        self.parts = {}        # 商品名 -> {中間商品名: 1個あたりの数}
+        self.part_of = {}      # 中間商品名 -> {商品名, ...}
+        self._craftable = {}   # 商品名 -> 今作れる最大数（レシピなしは None）
+        self._stale = set()    # 再計算が必要な商品
+        self.product_index = []    # 名前の昇順リスト（ページ送り・前方一致検索用）
+        self.material_index = []
+        self.version = 0       # いずれかのマスタが変わるたびに増える
+        self.loaded = False
+        self.hits = 0; self.misses = 0   # 名前引き・制作可能数の参照。miss は該当なし（削除済み）か再計算
+        self.loads = 0                   # 全件読み込みの回数（起動・遅延読み込み・一括インポート）
+
+    async def load(self):
+        self.install(await self.read())
+
+    async def read(self, conn=None):
+        """全件を読んで新しい構造一式をローカルに組み立てる（self は変えない）。
+        conn を渡すとそのトランザクション内で読むので、コミット前の自分の変更も見える。"""
+        async def fetch(sql):
+            return await (await conn.execute(sql)).fetchall() if conn else await db.fetchall(sql)
+        products = {n: Product(n, p, c) for n, p, c in await fetch("SELECT name, price, current FROM products")}
+        materials = {n: Material(n, c) for n, c in await fetch("SELECT name, current FROM materials")}
+        recipes = {}; used_in = {}
+        for p, m, q in await fetch("SELECT product_name, material_name, quantity FROM recipes"):
+            recipes.setdefault(p, {})[m] = q; used_in.setdefault(m, set()).add(p)
+        parts = {}; part_of = {}
+        for p, c, q in await fetch("SELECT product_name, part_name, quantity FROM recipe_parts"):
+            parts.setdefault(p, {})[c] = q; part_of.setdefault(c, set()).add(p)
+        return products, materials, recipes, used_in, parts, part_of
+
+    def install(self, data):
+        """read() の結果を await を挟まず一度に差し替える。読み込みの途中で制作が空のレシピや古い制作可能数を見ることはない。"""
+        self.products, self.materials, self.recipes, self.used_in, self.parts, self.part_of = data
+        if (cyc := find_cycle(self.parts)): print("recipe cycle:", " → ".join(cyc))
+        self._craftable = {}; self._stale = set(self.products)
+        self.product_index = sorted(self.products); self.material_index = sorted(self.materials)
+        self.loaded = True; self.version += 1; self.loads += 1
+        dashboard.mark_dirty("products"); dashboard.mark_dirty("materials")
+
+    async def ensure(self):
+        if not self.loaded: await self.load()
+        return self
+
+    def get_product(self, name):
+        p = self.products.get(name)
+        if p is None: self.misses += 1
+        else: self.hits += 1
+        return p
+
+    # --- レシピの展開 ---
+    def _topo(self, root):
+        """root から中間商品をたどった部分グラフを、使う側が使われる側より先に来る順で返す。"""
+        out = []; seen = {root}; stack = [(root, iter(self.parts.get(root, ())))]
+        while stack:
+            n, it = stack[-1]
+            nxt = next(it, None)
+            if nxt is None: out.append(n); stack.pop()
+            elif nxt not in seen: seen.add(nxt); stack.append((nxt, iter(self.parts.get(nxt, ()))))
+        out.reverse(); return out
+
+    def bom(self, product, qty):
+        """product を qty 個作るのに要る量を1回の走査で求める。中間商品は在庫を先に使い、足りない分だけ作る。
+        戻り値: (素材 {名前: 数}, 在庫から使う中間商品 {名前: 数}, 作る数 {商品名: 数}, 不足 ((名前, 必要数, 現在数), ...))"""
+        demand = {product: qty}; mats = {}; used = {}; made = {}; short = []
+        for n in self._topo(product):
+            d = demand.get(n, 0)
+            if d <= 0: continue
+            if n != product:
+                have = max(0, self.products[n].current) if n in self.products else 0
+                if (take := min(d, have)): used[n] = take; d -= take
+                if not d: continue
+                if not self.recipes.get(n) and not self.parts.get(n):
+                    short.append((n, demand[n], have)); continue
+            made[n] = d
+            for m, q in self.recipes.get(n, {}).items(): mats[m] = mats.get(m, 0) + q * d
+            for c, q in self.parts.get(n, {}).items(): demand[c] = demand.get(c, 0) + q * d
+        for m, need in mats.items():
+            cur = self.materials[m].current if m in self.materials else 0
+            if cur < need: short.append((m, need, cur))
+        return mats, used, made, tuple(short)
+
+    def max_craftable(self, name):
+        """今の在庫で作れる最大数。レシピがなければ None。"""
+        if name in self._stale or name not in self._craftable:
+            self.misses += 1
+            self._craftable[name] = self._compute_craftable(name); self._stale.discard(name)
+        else: self.hits += 1
+        return self._craftable[name]
+
+    def _compute_craftable(self, name):
+        rec = self.recipes.get(name, {})
+        if not rec and not self.parts.get(name): return None
+        if not self.parts.get(name):   # 素材だけのレシピは割り算で決まる
+            return max(0, min([self.materials[m].current // q if m in self.materials else 0 for m, q in rec.items() if q > 0] + [CRAFT_MAX]))
+        # 中間商品があると在庫の使い方で線形にならないので、作れるかどうか（単調）で二分探索する
+        ok = lambda n: not self.bom(name, n)[3]
+        if not ok(1): return 0
+        lo, hi = 1, 2
+        while hi <= CRAFT_MAX and ok(hi): lo, hi = hi, hi * 2
+        if hi > CRAFT_MAX: return CRAFT_MAX
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if ok(mid): lo = mid
+            else: hi = mid
+        return lo
+
+    def _mark(self, names):
+        """names と、それを中間商品として使う上位の商品すべてを再計算対象にする。"""
+        stack = list(names); seen = set()
+        while stack:
+            n = stack.pop()
+            if n in seen: continue
+            seen.add(n); self._stale.add(n); stack.extend(self.part_of.get(n, ()))
+
+    def would_cycle(self, product, part):
+        return find_cycle({**self.parts, product: {**self.parts.get(product, {}), part: 1}}) is not None
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit = f"hit {self.hits} / miss {self.misses} ({self.hits / total:.1%})" if total else "参照なし"
+        return f"{hit} / 全件読込 {self.loads}回"
+
+    # --- 書き込み側（必ずDBのCOMMIT後に呼ぶ） ---
+    def _bump(self, prod=None):
+        self.version += 1
+        if prod: prod.version += 1
+
+    @staticmethod
+    def _index_drop(index, name):
+        k = bisect.bisect_left(index, name)
+        if k < len(index) and index[k] == name: del index[k]
+
+    def add_product(self, name):
+        if name not in self.products:
+            self.products[name] = Product(name); bisect.insort(self.product_index, name); self._bump(); self._mark((name,))
+            dashboard.mark_dirty("products", (name,))
+
+    def set_price(self, name, price):
+        if (p := self.products.get(name)): p.price = price; self._bump(p); dashboard.mark_dirty("products", (name,))
+
+    def drop_product(self, name):
+        p = self.products.pop(name, None); self._index_drop(self.product_index, name)
+        for m in self.recipes.pop(name, {}): self.used_in.get(m, set()).discard(name)
+        for c in self.parts.pop(name, {}): self.part_of.get(c, set()).discard(name)
+        parents = self.part_of.pop(name, set())
+        for q in parents: self.parts.get(q, {}).pop(name, None)
+        self._mark(parents); self._craftable.pop(name, None); self._stale.discard(name)
+        self._bump(p); dashboard.mark_dirty("products", (name,))
+
+    def add_material(self, name):
+        if name not in self.materials:
+            self.materials[name] = Material(name); bisect.insort(self.material_index, name); self._bump()
+            dashboard.mark_dirty("materials", (name,))
+
+    def drop_material(self, name):
+        self.materials.pop(name, None); self._index_drop(self.material_index, name)
+        users = self.used_in.pop(name, set()); self._mark(users)
+        for p in users: self.recipes.get(p, {}).pop(name, None)
+        self._bump(); dashboard.mark_dirty("materials", (name,))
+
+    def set_recipe(self, product, material, qty):
+        self.recipes.setdefault(product, {})[material] = qty; self.used_in.setdefault(material, set()).add(product)
+        self._bump(); self._mark((product,))
+
+    def set_part(self, product, part, qty):
+        """中間商品の使用数を設定する（0以下なら外す）。循環しないことは呼び出し側で確認済みであること。"""
+        if qty > 0:
+            self.parts.setdefault(product, {})[part] = qty; self.part_of.setdefault(part, set()).add(product)
+        else:
+            self.parts.get(product, {}).pop(part, None); self.part_of.get(part, set()).discard(product)
+        self._bump(); self._mark((product,))
+
+    def adjust_material(self, name, delta):
+        if (m := self.materials.get(name)):
+            m.current += delta; self._mark(self.used_in.get(name, ())); dashboard.mark_dirty("materials", (name,))
+
+    def adjust_product(self, name, delta):
+        if (p := self.products.get(name)):
+            p.current += delta; self._mark(self.part_of.get(name, ())); dashboard.mark_dirty("products", (name,))
+
+cache = MasterCache()
+
+# ================= 2.6.1. 在庫ダッシュボード =================
+class StockDashboard:
+    """ITEM_PANEL_CH に置いた在庫メッセージ（区分ごとに1通）を編集で更新し続ける。
+    在庫が変わるとキャッシュから mark_dirty() が呼ばれ、DASHBOARD_INTERVAL 秒ごとに変わった行だけを作り直して反映する。"""
+    SECTIONS = {"products": "📦 商品（制作済み）", "materials": "🧪 素材（原材料）"}
+    EMBED_DESC_MAX = 4000     # 1 embed の説明文上限(4096)に余裕を持たせる
+    MESSAGE_TEXT_MAX = 5800   # 1 メッセージ内の embed 合計上限(6000)に余裕を持たせる
+
+    def __init__(self):
+        self.channel = None
+        self.messages = {}                            # 区分 -> discord.Message
+        self._lines = {s: {} for s in self.SECTIONS}  # 区分 -> {名前: 表示行}
+        self._sent = {}                               # 区分 -> 最後に送った説明文のタプル
+        self._dirty = {}                              # 区分 -> 名前の集合（None は全件）
+        self._event = asyncio.Event(); self.task = None
+        self.renders = 0; self.edits = 0
+
+    def mark_dirty(self, section, names=None):
+        if names is None or self._dirty.get(section, ()) is None: self._dirty[section] = None
+        else: self._dirty.setdefault(section, set()).update(names)
+        self._event.set()
+
+    def _line(self, section, name):
+        if section == "products":
+            p = cache.products.get(name)
+            return p and f"・{p.name}: `{p.current}`個 (単価:{p.price}円)"
+        m = cache.materials.get(name)
+        return m and f"・{m.name}: `{m.current}`個"
+
+    def _recompute(self, section, names):
+        lines = self._lines[section]
+        if names is None:
+            index = cache.product_index if section == "products" else cache.material_index
+            self._lines[section] = {n: self._line(section, n) for n in index}; return
+        for n in names:
+            if (l := self._line(section, n)): lines[n] = l
+            else: lines.pop(n, None)
+
+    def _pages(self, section):
+        """表示行を embed 単位に分割する。メッセージ全体の上限を超える分は件数だけ表示する。"""
+        index = cache.product_index if section == "products" else cache.material_index
+        lines = self._lines[section]; pages = []; cur = []; size = 0; total = 0
+        for n, name in enumerate(index):
+            l = lines.get(name)
+            if l is None: continue
+            if total + len(l) + 1 > self.MESSAGE_TEXT_MAX - 100:
+                cur.append(f"…ほか {len(index) - n}件（エクスポートで全件確認できます）"); break
+            if size + len(l) + 1 > self.EMBED_DESC_MAX: pages.append("\n".join(cur)); cur = []; size = 0
+            cur.append(l); size += len(l) + 1; total += len(l) + 1
+        pages.append("\n".join(cur) or "なし")
+        return tuple(pages)
+
+    def embeds(self, section, pages=None):
+        pages = pages or self._pages(section)
+        embeds = [discord.Embed(title=self.SECTIONS[section] if n == 0 else None, description=d, color=0x2b7bb9) for n, d in enumerate(pages)]
+        embeds[-1].set_footer(text=f"最終更新 {datetime.now():%m-%d %H:%M:%S}")
+        return embeds
+
+    async def attach(self, channel):
+        """前回のダッシュボードメッセージがあれば編集して使い回し、なければ送ってから更新ループを開始する。"""
+        self.channel = channel
+        for s in self.SECTIONS:
+            self._recompute(s, None)
+            self._sent[s] = self._pages(s)
+            msg = None
+            if (row := await load_panel_message(f"dash:{s}")) and row[0] == channel.id:
+                try: msg = await channel.get_partial_message(row[1]).edit(embeds=self.embeds(s, self._sent[s]))
+                except discord.NotFound: msg = None
+            if msg is None: msg = await self._send(s, self._sent[s])
+            self.messages[s] = msg
+        self._dirty.clear()
+        if not self.task or self.task.done(): self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._event.wait()
+            await asyncio.sleep(DASHBOARD_INTERVAL)   # この間の変更はまとめて1回で反映
+            self._event.clear()
+            dirty, self._dirty = self._dirty, {}
+            for section, names in dirty.items():
+                self._recompute(section, names); self.renders += 1
+                pages = self._pages(section)
+                if pages == self._sent.get(section): continue
+                try:
+                    msg = self.messages.get(section)
+                    if msg: await msg.edit(embeds=self.embeds(section, pages))
+                    elif self.channel: self.messages[section] = await self._send(section, pages)
+                    self._sent[section] = pages; self.edits += 1
+                except discord.NotFound:
+                    # 誰かに消された場合は次回送り直す
+                    self.messages.pop(section, None); self.mark_dirty(section)
+                except discord.HTTPException as e:
+                    # レート制限などは少し待って全体を描き直す
+                    await asyncio.sleep(getattr(e, "retry_after", None) or DASHBOARD_INTERVAL)
+                    self.mark_dirty(section)
+
+    async def _send(self, section, pages):
+        msg = await self.channel.send(embeds=self.embeds(section, pages))
+        await save_panel_message(f"dash:{section}", self.channel.id, msg.id)
+        return msg
+
+dashboard = StockDashboard()
+
+# ================= 2.7. 制作・売上エンジン =================
+class TxResult(NamedTuple):
+    ok: bool
+    error: str = ""          # "no_recipe" / "no_product" / "shortage" / "bad_qty" / "stale_price" / "no_sale" / "already_void"
+    shortfalls: tuple = ()   # ((名前, 必要数, 現在数), ...)
+    amount: int = 0
+    price: int = 0
+    sale_id: int = 0
+
+class _Abort(Exception):
+    """トランザクション内で不整合を検出したときにROLLBACKさせるための内部例外。"""
+    def __init__(self, result): self.result = result
+
+# キャッシュで展開した必要数を1行ずつ引く。在庫が足りない行は WHERE で弾かれ、rowcount に数えられない
+_SQL_TAKE_MATERIAL = "UPDATE materials SET current = current - ? WHERE name=? AND current >= ?"
+_SQL_TAKE_PRODUCT = "UPDATE products SET current = current - ? WHERE name=? AND current >= ?"
+
+async def craft_product(user_id, product, qty):
+    """レシピ全体（中間商品を含む）の必要量をキャッシュ上で展開し、足りなければDBに触れずに断る。
+    足りれば素材・中間商品の減算、商品加算、監査ログを1トランザクションで行う。"""
+    if qty <= 0: return TxResult(False, "bad_qty")
+    await cache.ensure()
+    if cache.max_craftable(product) is None: return TxResult(False, "no_recipe")
+    if (short := cache.bom(product, qty)[3]): return TxResult(False, "shortage", short)
+    try:
+        async with db.write() as conn:
+            # ロック取得までに他の処理がコミットしていれば在庫が変わっているので、ロック内で展開し直す
+            mats, used, made, short = cache.bom(product, qty)
+            if short: return TxResult(False, "shortage", short)
+            # 事前確認の後にレシピが消えていたら（削除・読み直し）、何も消費しない制作として通さない
+            if not mats and not used: return TxResult(False, "no_recipe")
+            # WHERE の在庫条件が最後の防波堤。1行でも更新できなければ全体を巻き戻す
+            changed = (await conn.executemany(_SQL_TAKE_MATERIAL, [(n, m, n) for m, n in mats.items()])).rowcount if mats else 0
+            if used: changed += (await conn.executemany(_SQL_TAKE_PRODUCT, [(n, c, n) for c, n in used.items()])).rowcount
+            if changed != len(mats) + len(used): raise _Abort(TxResult(False, "shortage"))
+            await conn.execute("UPDATE products SET current = current + ? WHERE name=?", (qty, product))
+            sub = ", ".join(f"{n} x{k}" for n, k in made.items() if n != product)
+            await conn.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)",
+                               (user_id, "制作", f"{product} x{qty}" + (f" (中間: {sub})" if sub else ""), int(time.time())))
+    except _Abort as e:
+        return e.result
+    for m, n in mats.items(): cache.adjust_material(m, -n)
+    for c, n in used.items(): cache.adjust_product(c, -n)
+    cache.adjust_product(product, qty)
+    return TxResult(True)
+
+async def sell_product(user_id, product, qty, expected_price=None):
+    """商品在庫の減算・売上台帳への追記・監査ログを1トランザクションで行う。単価はトランザクション内で確定し、
+    expected_price（画面に表示した単価）と食い違えば何もせず stale_price を返す。"""
+    if qty <= 0: return TxResult(False, "bad_qty")
+    async with db.write() as conn:
+        row = await (await conn.execute("SELECT price, current FROM products WHERE name=?", (product,))).fetchone()
+        if not row: return TxResult(False, "no_product")
+        price, current = row
+        if expected_price is not None and price != expected_price: return TxResult(False, "stale_price", price=price)
+        if current < qty: return TxResult(False, "shortage", ((product, qty, current),), price=price)
+
+        amt = price * qty; now = int(time.time())
+        await conn.execute("UPDATE products SET current = current - ? WHERE name=? AND current >= ?", (qty, product, qty))
+        sale_id = (await conn.execute("INSERT INTO sales (user_id, product, qty, unit_price, ts) VALUES (?,?,?,?,?)",
+                                      (user_id, product, qty, price, now))).lastrowid
+        await project_sales(conn)
+        await conn.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)",
+                           (user_id, "売上", f"{product} x{qty} ({amt:,}円)", now))
+    cache.adjust_product(product, -qty)
+    return TxResult(True, amount=amt, price=price, sale_id=sale_id)
+
+async def void_sale(user_id, sale_id):
+    """売上を取り消す。元の行は残したまま負の行を追記し、商品在庫を戻す。"""
+    async with db.write() as conn:
+        row = await (await conn.execute("SELECT user_id, product, qty, unit_price, kind, EXISTS(SELECT 1 FROM sales v WHERE v.ref = s.id) "
+                                        "FROM sales s WHERE id=?", (sale_id,))).fetchone()
+        if not row or row[4] != "sale": return TxResult(False, "no_sale")
+        seller, product, qty, price, _, voided = row
+        if voided: return TxResult(False, "already_void")
+        now = int(time.time())
+        await conn.execute("INSERT INTO sales (user_id, product, qty, unit_price, ts, kind, ref) VALUES (?,?,?,?,?,'void',?)",
+                           (seller, product, -qty, price, now, sale_id))
+        restored = (await conn.execute("UPDATE products SET current = current + ? WHERE name=?", (qty, product))).rowcount
+        await project_sales(conn)
+        await conn.execute("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)",
+                           (user_id, "売上取消", f"#{sale_id} <@{seller}> {product} x{qty} ({qty * price:,}円)", now))
+    if restored: cache.adjust_product(product, qty)
+    return TxResult(True, amount=qty * price, price=price, sale_id=sale_id)
+
+# ================= 2.8. 累計（勤怠分・売上）の差分集計 =================
+TOTAL_BUCKETS = {"all": "全期間", "d": "今日", "w": "今週", "m": "今月"}
+
+def bucket_key(kind, ts):
+    dt = datetime.fromtimestamp(ts)
+    if kind == "d": return f"d:{dt:%Y-%m-%d}"
+    if kind == "w": y, w, _ = dt.isocalendar(); return f"w:{y}-W{w:02d}"
+    if kind == "m": return f"m:{dt:%Y-%m}"
+    return "all"
+
+def bucket_sql(kind, col):
+    """bucket_key と同じキーを作るSQL式（col はUNIX秒の列）。ISO週はその週の木曜日の年と通算日から求める。"""
+    t = f"{col}, 'unixepoch', 'localtime'"
+    if kind == "d": return f"'d:' || date({t})"
+    if kind == "w":
+        thu = f"date({t}, '-3 days', 'weekday 4')"
+        return f"'w:' || strftime('%Y', {thu}) || '-W' || printf('%02d', (strftime('%j', {thu}) - 1) / 7 + 1)"
+    if kind == "m": return f"'m:' || strftime('%Y-%m', {t})"
+    return "'all'"
+
+_SQL_BUMP_TOTALS = """
+    INSERT INTO user_totals (bucket, user_id, work_minutes, sales_amount) VALUES (?,?,?,?)
+    ON CONFLICT(bucket, user_id) DO UPDATE SET
+        work_minutes = work_minutes + excluded.work_minutes, sales_amount = sales_amount + excluded.sales_amount"""
+
+async def bump_totals(conn, user_id, ts, work=0, sales=0):
+    """呼び出し元のトランザクション内で、ts が属する全バケットの累計を加算する。"""
+    await conn.executemany(_SQL_BUMP_TOTALS, [(bucket_key(k, ts), user_id, work, sales) for k in TOTAL_BUCKETS])
+
+async def top_totals(kind, column, offset, limit):
+    """順序付きインデックスから指定範囲だけ読む。次ページ有無の判定用に1件多く返す。"""
+    col = "sales_amount" if column == "sales" else "work_minutes"
+    return await db.fetchall(f"SELECT user_id, {col} FROM user_totals WHERE bucket=? AND {col} > 0 ORDER BY {col} DESC LIMIT ? OFFSET ?",
+                             (bucket_key(kind, int(time.time())), limit + 1, offset))
+
+# ================= 2.8.1. 日次ロールアップと期間分析 =================
+SALE_DETAIL_RE = re.compile(r"^(.+) x(\d+) \(([\d,]+)円\)$")   # 売上の監査ログ文面
+ANALYTICS_REPORTS = {"work": "勤怠（ユーザー別）", "sales_user": "売上（ユーザー別）", "sales_product": "売上（商品別）"}
+ANALYTICS_PRESETS = {"w": "今週", "lw": "先週", "m": "今月", "lm": "先月", "period": "今期（締め以降）"}
+CHART_MAX_DAYS = 731
+
+def day_key(ts):
+    return f"{datetime.fromtimestamp(ts):%Y-%m-%d}"
+
+def next_day_key():
+    """期間締めで記録する新しい期間の開始日（明日）。"""
+    return f"{datetime.now().date() + timedelta(days=1):%Y-%m-%d}"
+
+def split_days(start, end):
+    """[start, end) を日付ごとの分数に分ける。累積秒の切り捨て差で配るので、合計は (end-start)//60 と一致する。"""
+    out = []; t = start; done = 0
+    while t < end:
+        midnight = datetime.fromtimestamp(t).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        nxt = min(end, int(midnight.timestamp()))
+        m = (nxt - start) // 60 - done; done += m
+        if m: out.append((day_key(t), m))
+        t = nxt
+    return out
+
+_SQL_BUMP_DAILY_WORK = """
+    INSERT INTO daily_work (day, user_id, minutes) VALUES (?,?,?)
+    ON CONFLICT(day, user_id) DO UPDATE SET minutes = minutes + excluded.minutes"""
+_SQL_BUMP_DAILY_SALES = """
+    INSERT INTO daily_sales (day, user_id, product, qty, amount) VALUES (?,?,?,?,?)
+    ON CONFLICT(day, user_id, product) DO UPDATE SET qty = qty + excluded.qty, amount = amount + excluded.amount"""
+
+async def bump_daily_work(conn, user_id, start, end):
+    await conn.executemany(_SQL_BUMP_DAILY_WORK, [(d, user_id, m) for d, m in split_days(start, end)])
+
+async def bump_daily_sales(conn, user_id, product, qty, amount, ts):
+    await conn.execute(_SQL_BUMP_DAILY_SALES, (day_key(ts), user_id, product, qty, amount))
+
+def parse_range(text):
+    """'YYYY-MM-DD YYYY-MM-DD' / 'YYYY-MM-DD' / 'YYYY-MM' を (開始日, 終了日) にする（終了日を含む）。"""
+    parts = [p for p in re.split(r"[\s~〜]+", text.strip()) if p]
+    if len(parts) == 1 and re.fullmatch(r"\d{4}-\d{2}", parts[0]):
+        s = datetime.strptime(parts[0], "%Y-%m"); e = (s + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    elif len(parts) in (1, 2):
+        s, e = datetime.strptime(parts[0], "%Y-%m-%d"), datetime.strptime(parts[-1], "%Y-%m-%d")
+    else:
+        raise ValueError(text)
+    if e < s: raise ValueError(text)
+    return f"{s:%Y-%m-%d}", f"{e:%Y-%m-%d}"
+
+async def period_start(user_id=None):
+    """直近の締め日（全体 or 個人）。締めたことがなければ空文字（= 最初から）。"""
+    sql = "SELECT MAX(day) FROM period_closes WHERE user_id IS NULL" if user_id is None else "SELECT MAX(day) FROM period_closes WHERE user_id=?"
+    return (await db.fetchone(sql, () if user_id is None else (user_id,)))[0] or ""
+
+async def preset_range(kind):
+    today = datetime.now().date(); week = today - timedelta(days=today.weekday())
+    if kind == "w": s, e = week, today
+    elif kind == "lw": s, e = week - timedelta(days=7), week - timedelta(days=1)
+    elif kind == "m": s, e = today.replace(day=1), today
+    elif kind == "lm": e = today.replace(day=1) - timedelta(days=1); s = e.replace(day=1)
+    else: return await period_start(), f"{today:%Y-%m-%d}"
+    return f"{s:%Y-%m-%d}", f"{e:%Y-%m-%d}"
+
+def _report_sql(report, period):
+    table, val = ("daily_work", "SUM(minutes), 0") if report == "work" else ("daily_sales", "SUM(amount), SUM(qty)")
+    key = "product" if report == "sales_product" else "user_id"
+    # 今期は個人締めも反映する（その人の締め日より前は数えない）
+    cond = " AND day >= COALESCE((SELECT MAX(c.day) FROM period_closes c WHERE c.user_id = t.user_id), '')" if period else ""
+    return table, key, val, cond
+
+async def range_totals(report, d0, d1, offset=0, limit=-1, period=False):
+    """期間内の (キー, 値, 数量) を値の降順で返す。勤怠は分、売上は金額。"""
+    table, key, val, cond = _report_sql(report, period)
+    return await db.fetchall(f"SELECT {key}, {val} FROM {table} t WHERE day BETWEEN ? AND ?{cond} GROUP BY {key} ORDER BY 2 DESC LIMIT ? OFFSET ?",
+                             (d0, d1, limit, offset))
+
+async def daily_series(report, d0, d1, period=False):
+    """期間内の日別合計。記録のない日は0で埋める。"""
+    table, _, val, cond = _report_sql(report, period)
+    got = dict((r[0], r[1]) for r in await db.fetchall(f"SELECT day, {val} FROM {table} t WHERE day BETWEEN ? AND ?{cond} GROUP BY day", (d0, d1)))
+    s, e = datetime.strptime(d0 or min(got, default=d1), "%Y-%m-%d"), datetime.strptime(d1, "%Y-%m-%d")
+    return [(f"{d:%Y-%m-%d}", got.get(f"{d:%Y-%m-%d}", 0)) for d in (s + timedelta(days=k) for k in range((e - s).days + 1))]
+
+def _width(text):
+    return sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
+
+def text_table(headers, rows, align):
+    """等幅表示用の表。align は列ごとに '<' か '>'（全角文字は幅2で数える）。"""
+    cells = [list(map(str, headers))] + [[str(c) for c in r] for r in rows]
+    widths = [max(_width(r[k]) for r in cells) for k in range(len(headers))]
+    def line(r): return "  ".join(c + " " * (w - _width(c)) if a == "<" else " " * (w - _width(c)) + c for c, w, a in zip(r, widths, align)).rstrip()
+    return "\n".join(line(r) for r in cells)
+
+def fmt_minutes(m):
+    return f"{m // 60}時間{m % 60:02d}分"
+
+def bar_chart_png(values, height=240, color=(88, 101, 242)):
+    """値の列を棒グラフのPNGにする（zlib と struct だけで書く。文字は描かないので数値は本文に添える）。"""
+    pad = 8; n = max(1, len(values)); bw = max(1, 704 // n); width = n * bw + 2 * pad
+    top = max(values, default=0) or 1; plot_h = height - 2 * pad
+    rows = [bytearray(b"\xff" * (width * 3)) for _ in range(height)]
+    for q in (0, .25, .5, .75, 1):
+        rows[height - pad - int(plot_h * q)][pad * 3:(width - pad) * 3] = bytes((220, 220, 220)) * (width - 2 * pad)
+    for k, v in enumerate(values):
+        x0 = pad + k * bw; x1 = x0 + (bw - 1 if bw > 2 else bw); seg = bytes(color) * (x1 - x0)
+        for y in range(height - pad - int(plot_h * v / top), height - pad): rows[y][x0 * 3:x1 * 3] = seg
+    def chunk(tag, data): return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    raw = b"".join(b"\x00" + bytes(r) for r in rows)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+# ================= 2.8.2. 売上台帳からの射影 =================
+# 取消行は元の売上の日付に効かせる（当日の集計をマイナスにしない）
+_SQL_UNPROJECTED_SALES = """
+    SELECT s.id, s.user_id, s.product, s.qty, s.unit_price, COALESCE(o.ts, s.ts)
+    FROM sales s LEFT JOIN sales o ON o.id = s.ref WHERE s.id > ? ORDER BY s.id"""
+
+async def project_sales(conn):
+    """台帳のうち未反映の行を売上ランキング・累計・日次集計に足し込む（呼び出し元のトランザクション内）。
+    集計表はすべて台帳から作り直せる派生データで、直接書き換えるのはここだけ。"""
+    last = (await (await conn.execute("SELECT last_id FROM projections WHERE name='sales'")).fetchone())[0]
+    rows = await (await conn.execute(_SQL_UNPROJECTED_SALES, (last,))).fetchall()
+    for _, uid, product, qty, price, ts in rows:
+        amt = qty * price
+        await conn.execute("INSERT INTO sales_ranking (user_id, total_amount) VALUES (?,?) ON CONFLICT(user_id) DO UPDATE SET total_amount = total_amount + excluded.total_amount", (uid, amt))
+        await bump_totals(conn, uid, ts, sales=amt)
+        await bump_daily_sales(conn, uid, product, qty, amt, ts)
+    if rows: await conn.execute("UPDATE projections SET last_id=? WHERE name='sales'", (rows[-1][0],))
+    return len(rows)
+
+# ================= 2.9. 監査ログ（バッチ書き込み・保持期間） =================
+class AuditWriter:
+    """監査ログをasyncio.Queueに積み、件数か経過時間のどちらかでまとめて1トランザクションに書き込む。
+    制作・売上の監査行は本体トランザクション内で書くため、ここを通るのは管理操作などのログ。"""
+    def __init__(self):
+        self.queue = None; self.task = None; self._pending = []
+        self.commits = 0; self.rows = 0; self.failed = 0; self.spilled = 0
+
+    def start(self):
+        if self.task and not self.task.done(): return
+        if self.queue is None: self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, user_id, action, detail):
+        self.start()
+        self.queue.put_nowait((user_id, action, detail, int(time.time())))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False; errors = 0
+        while True:
+            if not self._pending:
+                if stopping: return
+                item = await self.queue.get()
+                if item is None: return
+                self._pending.append(item)
+            deadline = loop.time() + AUDIT_FLUSH_SEC
+            while not stopping and len(self._pending) < AUDIT_BATCH_SIZE:
+                try: item = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError: break
+                if item is None: stopping = True
+                else: self._pending.append(item)
+            # 書き込みに失敗しても _pending は残し、間を空けて次の分と一緒に書き直す
+            try:
+                await self._flush(); errors = 0
+            except Exception as e:
+                errors += 1; self.failed += 1
+                print(f"audit flush failed ({len(self._pending)} rows kept): {e!r}")
+                if stopping and errors >= AUDIT_DRAIN_RETRIES: return self._spill()
+                await asyncio.sleep(AUDIT_FLUSH_SEC)
+
+    async def _flush(self):
+        if not self._pending: return
+        n = len(self._pending)
+        async with db.write() as conn:
+            await conn.executemany("INSERT INTO audit_logs (user_id, action, detail, created_at) VALUES (?,?,?,?)", self._pending[:n])
+        del self._pending[:n]   # コミットできてから手放す
+        self.commits += 1; self.rows += n
+
+    def _spill(self):
+        """停止時に書き込めなかった分をJSON Linesへ退避する（再起動後に手で取り込める形）。"""
+        path = os.path.join(AUDIT_ARCHIVE_DIR, "audit_unsaved.jsonl")
+        os.makedirs(AUDIT_ARCHIVE_DIR, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for u, a, d, c in self._pending:
+                f.write(json.dumps({"user_id": u, "action": a, "detail": d, "created_at": c}, ensure_ascii=False) + "\n")
+        self.spilled += len(self._pending)
+        print(f"audit: {len(self._pending)} unsaved rows written to {path}")
+        self._pending = []
+
+    async def drain(self):
+        """キューに残った分をすべて書き込んでワーカーを止める（停止・再起動前に呼ぶ）。"""
+        if not self.task or self.task.done(): return
+        self.queue.put_nowait(None)
+        await self.task
+
+audit = AuditWriter()
+
+def add_audit(user_id, action, detail):
+    audit.put(user_id, action, detail)
+
+async def archive_audit_logs(days=AUDIT_RETENTION_DAYS, chunk=5000):
+    """保持期間を過ぎた監査ログを月ごとのgzip(JSON Lines)へ追記し、テーブルから削除する。"""
+    cutoff = int((datetime.now() - timedelta(days=days)).timestamp())
+    os.makedirs(AUDIT_ARCHIVE_DIR, exist_ok=True)
+    last_id = 0; moved = 0
+    while True:
+        rows = await db.fetchall("SELECT id, user_id, action, detail, created_at FROM audit_logs WHERE id > ? AND created_at < ? ORDER BY id LIMIT ?",
+                                 (last_id, cutoff, chunk))
+        if not rows: break
+        by_month = {}
+        for r in rows: by_month.setdefault(f"{datetime.fromtimestamp(r[4]):%Y-%m}", []).append(r)
+        await asyncio.to_thread(_append_archive, by_month)
+        # 書き出し済みの範囲だけ消す
+        async with db.write() as conn:
+            await conn.execute("DELETE FROM audit_logs WHERE id > ? AND id <= ? AND created_at < ?", (last_id, rows[-1][0], cutoff))
+        last_id = rows[-1][0]; moved += len(rows)
+    # PASSIVEは書き込みを待たせないので、書き込みロックを取らずに読み取り用接続から流す
+    if moved: await db.fetchone("PRAGMA wal_checkpoint(PASSIVE)")
+    return moved
+
+def _append_archive(by_month):
+    for month, rows in by_month.items():
+        # gzipは追記するとメンバーが連結され、そのままgzip.openで通しで読める
+        with gzip.open(os.path.join(AUDIT_ARCHIVE_DIR, f"audit_{month}.jsonl.gz"), "at", encoding="utf-8") as f:
+            for i, u, a, d, c in rows:
+                f.write(json.dumps({"id": i, "user_id": u, "action": a, "detail": d, "created_at": c}, ensure_ascii=False) + "\n")
+
+@tasks.loop(hours=24)
+async def audit_maintenance():
+    moved = await archive_audit_logs()
+    if moved: print(f"audit: archived {moved} rows")
+
+# ================= 2.10. マスタ一括インポート / CSVエクスポート =================
+IMPORT_FIELDS = ("type", "name", "price", "current", "material", "part", "quantity")   # CSVの見出しとして受け付ける列
+IMPORT_MAX_ERRORS = 20
+
+class ImportPlan:
+    """アップロードされたファイルを1行ずつ読み、検証済みの変更内容を溜める。
+    行形式は IMPORT_FIELDS（type は product/material/recipe/part）"""
+    def __init__(self):
+        self.products = {}    # 名前 -> (単価 or None, 在庫 or None)
+        self.materials = {}   # 名前 -> 在庫 or None
+        self.recipes = {}     # (商品, 素材) -> 数
+        self.parts = {}       # (商品, 中間商品) -> 数
+        self.errors = []; self.rows = 0
+
+    def error(self, line, msg):
+        if len(self.errors) < IMPORT_MAX_ERRORS: self.errors.append(f"{line}行目: {msg}")
+        elif len(self.errors) == IMPORT_MAX_ERRORS: self.errors.append("…（以降省略）")
+
+    def add(self, line, row):
+        self.rows += 1
+        # JSONは行ごとにキーを持つので、CSVの見出しと同じく知らないキー（qty, prices など）は黙って捨てずに止める
+        if (bad := [k for k in row if k not in IMPORT_FIELDS]): return self.error(line, f"不明な列: {', '.join(map(str, bad))}")
+        kind = (row.get("type") or "").strip().lower(); name = (row.get("name") or "").strip()
+        if not name: return self.error(line, "name が空です")
+        try:
+            price, current, qty = (None if row.get(k) in (None, "") else int(row[k]) for k in ("price", "current", "quantity"))
+        except (TypeError, ValueError):
+            return self.error(line, "数値の列に数字以外が入っています")
+        if (price or 0) < 0 or (current or 0) < 0: return self.error(line, "price / current に負の値は使えません")
+        if kind == "product": self.products[name] = (price, current)
+        elif kind == "material": self.materials[name] = current
+        elif kind == "recipe":
+            mat = (row.get("material") or "").strip()
+            if not mat or not qty or qty <= 0: return self.error(line, "recipe には material と1以上の quantity が必要です")
+            self.recipes[(name, mat)] = qty
+        elif kind == "part":
+            part = (row.get("part") or "").strip()
+            if not part or not qty or qty <= 0: return self.error(line, "part には part と1以上の quantity が必要です")
+            if part == name: return self.error(line, "商品自身は中間商品にできません")
+            self.parts[(name, part)] = qty
+        else: self.error(line, f"不明な type: {kind}")
+
+    def validate(self):
+        # レシピが参照する名前は、既存マスタか同じファイル内に存在すること
+        for (p, m) in self.recipes:
+            if p not in self.products and p not in cache.products: self.error("-", f"レシピの商品が存在しません: {p}")
+            if m not in self.materials and m not in cache.materials: self.error("-", f"レシピの素材が存在しません: {m}")
+        for (p, c) in self.parts:
+            for n in (p, c):
+                if n not in self.products and n not in cache.products: self.error("-", f"レシピの商品が存在しません: {n}")
+        merged = {k: dict(v) for k, v in cache.parts.items()}
+        for (p, c), q in self.parts.items(): merged.setdefault(p, {})[c] = q
+        if (cyc := find_cycle(merged)): self.error("-", "レシピが循環しています: " + " → ".join(cyc))
+
+    def diff_text(self):
+        new_p = sum(1 for n in self.products if n not in cache.products)
+        chg_price = sum(1 for n, (pr, _) in self.products.items() if n in cache.products and pr is not None and cache.products[n].price != pr)
+        new_m = sum(1 for n in self.materials if n not in cache.materials)
+        chg_stock = sum(1 for n, c in self.materials.items() if n in cache.materials and c is not None and cache.materials[n].current != c)
+        chg_stock += sum(1 for n, (_, c) in self.products.items() if n in cache.products and c is not None and cache.products[n].current != c)
+        new_r = sum(1 for (p, m) in self.recipes if m not in cache.recipes.get(p, {}))
+        chg_r = sum(1 for (p, m), q in self.recipes.items() if cache.recipes.get(p, {}).get(m, q) != q)
+        new_r += sum(1 for (p, c) in self.parts if c not in cache.parts.get(p, {}))
+        chg_r += sum(1 for (p, c), q in self.parts.items() if cache.parts.get(p, {}).get(c, q) != q)
+        return (f"読込 {self.rows:,}行\n・商品: 新規 {new_p:,} / 単価変更 {chg_price:,}\n・素材: 新規 {new_m:,}\n"
+                f"・在庫の上書き: {chg_stock:,}\n・レシピ: 新規 {new_r:,} / 数量変更 {chg_r:,}")
+
+def parse_import(filename, data):
+    """CSV / JSON Lines は1行ずつ、JSON は配列（または {"rows": [...]}）として読む。"""
+    plan = ImportPlan()
+    text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+    ext = os.path.splitext(filename.lower())[1]
+    try:
+        if ext == ".csv":
+            reader = csv.DictReader(text)
+            head = [(f or "").strip().lower() for f in reader.fieldnames or ()]
+            # 列名の打ち間違い（qty など）は黙って空欄扱いにせず、読み込み前に止める
+            if (bad := [f for f in head if f not in IMPORT_FIELDS]) or not {"type", "name"} <= set(head):
+                plan.error(1, f"見出しが不正です（不明な列: {', '.join(bad) or 'なし'}）。使える列: {','.join(IMPORT_FIELDS)}")
+                return plan
+            reader.fieldnames = head
+            for n, row in enumerate(reader, 2): plan.add(n, row)
+        elif ext == ".jsonl":
+            for n, line in enumerate(text, 1):
+                if line.strip(): plan.add(n, json.loads(line))
+        elif ext == ".json":
+            rows = json.load(text)
+            for n, row in enumerate(rows["rows"] if isinstance(rows, dict) else rows, 1): plan.add(n, row)
+        else:
+            plan.error("-", "対応形式は .csv / .json / .jsonl です")
+    except (ValueError, csv.Error, UnicodeDecodeError, KeyError, TypeError, AttributeError) as e:
+        plan.error("-", f"ファイルを読めません: {e}")
+    if not plan.errors: plan.validate()
+    return plan
+
+async def apply_import(plan, user_id):
+    """検証済みの内容を1トランザクションでまとめてUPSERTし、同じトランザクション内でキャッシュを読み直す。"""
+    async with db.write() as conn:
+        await conn.executemany("""INSERT INTO products (name, price, current) VALUES (?, COALESCE(?, 0), COALESCE(?, 0))
+            ON CONFLICT(name) DO UPDATE SET price = COALESCE(?, price), current = COALESCE(?, current)""",
+            ((n, p, c, p, c) for n, (p, c) in plan.products.items()))
+        await conn.executemany("""INSERT INTO materials (name, current) VALUES (?, COALESCE(?, 0))
+            ON CONFLICT(name) DO UPDATE SET current = COALESCE(?, current)""",
+            ((n, c, c) for n, c in plan.materials.items()))
+        await conn.executemany("INSERT OR REPLACE INTO recipes (product_name, material_name, quantity) VALUES (?,?,?)",
+            ((p, m, q) for (p, m), q in plan.recipes.items()))
+        await conn.executemany("INSERT OR REPLACE INTO recipe_parts (product_name, part_name, quantity) VALUES (?,?,?)",
+            ((p, c, q) for (p, c), q in plan.parts.items()))
+        # 書き込みロックを持ったまま読むので、UPSERTから差し替えまでの間に他の制作・売上がコミットされることはない
+        fresh = await cache.read(conn)
+    cache.install(fresh)   # COMMIT直後に await を挟まず差し替える（COMMITが失敗したら古いキャッシュのまま）
+    add_audit(user_id, "一括インポート", f"商品{len(plan.products)} 素材{len(plan.materials)} レシピ{len(plan.recipes) + len(plan.parts)}")
+
+EXPORT_KINDS = {"stock": "在庫", "work": "勤怠", "sales": "売上"}
+
+def month_range(month):
+    """'YYYY-MM' をその月の [開始, 翌月開始) のUNIX秒に変換する。"""
+    start = datetime.strptime(month, "%Y-%m")
+    end = (start + timedelta(days=32)).replace(day=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+async def _iter_rows(sql, params=(), chunk=1000):
+    async with db.read() as conn:
+        cur = await conn.execute(sql, params)
+        while rows := await cur.fetchmany(chunk):
+            for r in rows: yield r
+
+def _fmt_ts(ts): return "" if ts is None else f"{datetime.fromtimestamp(ts):%Y-%m-%d %H:%M:%S}"
+
+async def export_csv(kind, month=None):
+    """指定種別をCSVにして返す（discord.File）。行はチャンク単位で一時ファイルへ書き出す。"""
+    lo, hi = month_range(month) if month else (0, 2**62)
+    if kind == "stock":
+        header = ("type", "name", "price", "current")
+        rows = _iter_rows("SELECT 'product', name, price, current FROM products UNION ALL SELECT 'material', name, NULL, current FROM materials")
+    elif kind == "work":
+        header = ("user_id", "start", "end", "duration_min")
+        rows = _iter_rows("SELECT user_id, start, end, duration FROM work_logs WHERE start >= ? AND start < ? ORDER BY start", (lo, hi))
+    else:
+        header = ("sale_id", "ts", "user_id", "product", "qty", "unit_price", "amount", "kind", "ref")
+        rows = _iter_rows("SELECT id, ts, user_id, product, qty, unit_price, qty * unit_price, kind, ref FROM sales WHERE ts >= ? AND ts < ? ORDER BY ts, id", (lo, hi))
+
+    buf = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024)
+    text = io.TextIOWrapper(buf, encoding="utf-8-sig", newline="")
+    w = csv.writer(text); w.writerow(header)
+    async for r in rows:
+        if kind == "work": r = (r[0], _fmt_ts(r[1]), _fmt_ts(r[2]), r[3])
+        elif kind == "sales": r = (r[0], _fmt_ts(r[1])) + tuple(r[2:])
+        w.writerow(r)
+    text.flush(); text.detach(); buf.seek(0)
+    return discord.File(buf, filename=f"{kind}_{month or 'all'}.csv")
+
+# ================= 2.11. 応答時間の計測 =================
+_perf_cur = contextvars.ContextVar("perf_cur", default=None)   # 実行中ハンドラの [SQL秒, SQL回数, 計測中か, API秒, API回数]
+_deferring = {}      # interaction.id -> 自動defer中のTask
+_responding = set()  # 初回応答のHTTP呼び出しが進行中の interaction.id（is_done() はその完了後に立つ）
+
+class PerfMonitor:
+    """ハンドラごとの応答時間ヒストグラム（全件）と、直近サンプルのリングバッファ（間引き）を持つ。"""
+    BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2000, 3000)
+
+    def __init__(self):
+        self.hist = {}     # ハンドラ名 -> [各バケット件数..., +Inf件数]
+        self.totals = {}   # ハンドラ名 -> [件数, 合計ms, SQL合計ms, SQL回数, 自動defer回数, API合計ms, API回数]
+        self.ring = deque(maxlen=PERF_RING_SIZE)   # (ハンドラ名, 合計ms, SQLms, SQL回数, APIms)
+
+    def add_sql(self, sec, n=1):
+        s = _perf_cur.get()
+        if s and s[2]: s[0] += sec; s[1] += n
+
+    def add_api(self, sec):
+        s = _perf_cur.get()
+        if s and s[2]: s[3] += sec; s[4] += 1
+
+    @asynccontextmanager
+    async def measure(self, name, interaction=None):
+        s = [0.0, 0, True, 0.0, 0]; token = _perf_cur.set(s)
+        watchdog = None
+        if interaction is not None:
+            watchdog = asyncio.get_running_loop().call_later(PERF_DEFER_AFTER, self._auto_defer, name, interaction)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - t) * 1000
+            s[2] = False; _perf_cur.reset(token)
+            if watchdog: watchdog.cancel()
+            if interaction is not None: _deferring.pop(interaction.id, None)
+            self._record(name, ms, s[0] * 1000, s[1], s[3] * 1000, s[4])
+
+    def _auto_defer(self, name, interaction):
+        # 応答のHTTP呼び出しが進行中なら is_done() はまだ False なので、_responding も見て二重応答を避ける
+        if interaction.response.is_done() or interaction.id in _responding or interaction.id in _deferring: return
+        self.totals.setdefault(name, [0, 0.0, 0.0, 0, 0, 0.0, 0])[4] += 1
+        _deferring[interaction.id] = asyncio.create_task(_respond_once(interaction, "defer", ephemeral=True))
+
+    def _record(self, name, ms, sql_ms, sql_n, api_ms, api_n):
+        h = self.hist.get(name)
+        if h is None: h = self.hist[name] = [0] * (len(self.BUCKETS_MS) + 1)
+        h[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        t = self.totals.setdefault(name, [0, 0.0, 0.0, 0, 0, 0.0, 0])
+        t[0] += 1; t[1] += ms; t[2] += sql_ms; t[3] += sql_n; t[5] += api_ms; t[6] += api_n
+        if random.random() < PERF_SAMPLE_RATE: self.ring.append((name, ms, sql_ms, sql_n, api_ms))
+
+    def report(self, top=15):
+        """直近サンプルからハンドラごとの p50/p95/p99 を計算して文字列にする。"""
+        by = {}
+        for name, ms, sql_ms, n, api_ms in self.ring: by.setdefault(name, []).append((ms, sql_ms, n, api_ms))
+        def pct(xs, q): return xs[min(len(xs) - 1, int(len(xs) * q))]
+        rows = []
+        for name, xs in by.items():
+            lat = sorted(x[0] for x in xs); sql = sum(x[1] for x in xs); api = sum(x[3] for x in xs); tot = sum(lat) or 1
+            # 合計時間に対する割合。残り（100% - SQL - API）がPython側の処理とイベントループ待ち
+            rows.append((pct(lat, 0.95), f"`{name}` n={len(xs)} p50 {pct(lat, .5):.1f} / p95 {pct(lat, .95):.1f} / p99 {pct(lat, .99):.1f}ms "
+                                         f"SQL {sql / tot:.0%} ({sum(x[2] for x in xs) / len(xs):.1f}回) / API {api / tot:.0%}"))
+        rows.sort(reverse=True)
+        defers = sum(t[4] for t in self.totals.values()); slow = sum(h[-1] + h[-2] for h in self.hist.values())
+        head = f"⏱ **性能レポート**（直近{len(self.ring)}サンプル・遅い順）\n2秒超: {slow}件 / 自動defer: {defers}件 / キャッシュ: {cache.stats()}\n"
+        return head + ("\n".join(r[1] for r in rows[:top]) if rows else "データなし")
+
+    def prometheus(self):
+        out = ["# TYPE omnis_handler_latency_ms histogram"]
+        for name, h in sorted(self.hist.items()):
+            acc = 0
+            for le, c in zip(self.BUCKETS_MS + ("+Inf",), h):
+                acc += c; out.append(f'omnis_handler_latency_ms_bucket{{handler="{name}",le="{le}"}} {acc}')
+            t = self.totals[name]
+            out.append(f'omnis_handler_latency_ms_sum{{handler="{name}"}} {t[1]:.1f}')
+            out.append(f'omnis_handler_latency_ms_count{{handler="{name}"}} {t[0]}')
+            out.append(f'omnis_handler_sql_ms_sum{{handler="{name}"}} {t[2]:.1f}')
+            out.append(f'omnis_handler_sql_queries_total{{handler="{name}"}} {t[3]}')
+            out.append(f'omnis_handler_auto_defer_total{{handler="{name}"}} {t[4]}')
+            out.append(f'omnis_handler_api_ms_sum{{handler="{name}"}} {t[5]:.1f}')
+            out.append(f'omnis_handler_api_calls_total{{handler="{name}"}} {t[6]}')
+        return "\n".join(out) + "\n"
+
+    def dump(self, path=PERF_PROM_FILE):
+        if not path: return
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f: f.write(self.prometheus())
+        os.replace(tmp, path)
+
+perf = PerfMonitor()
+
+@tasks.loop(seconds=60)
+async def perf_dump():
+    perf.dump()
+
+async def _settle(i):
+    """自動deferが走っていれば、その完了を待つ。"""
+    if (t := _deferring.get(i.id)): await t
+
+async def _api(coro):
+    """Discord API の呼び出しを待ち、その時間を実行中ハンドラのAPI時間として数える。"""
+    t = time.perf_counter()
+    try: return await coro
+    finally: perf.add_api(time.perf_counter() - t)
+
+async def _respond_once(i, method, *args, **kw):
+    """i.response.<method> を初回応答として呼ぶ。既に応答済み・応答中なら呼ばずに False を返す。
+    初回応答（自動deferを含む）はすべてここを通し、呼び出し中は _responding で他の応答を止める。"""
+    if i.response.is_done() or i.id in _responding: return False
+    _responding.add(i.id)
+    try: await _api(getattr(i.response, method)(*args, **kw))
+    finally: _responding.discard(i.id)
+    return True
+
+async def reply(i, content=None, **kw):
+    """send_message の代わり。自動defer済みならフォローアップで送る。"""
+    await _settle(i)
+    if not await _respond_once(i, "send_message", content, **kw): await _api(i.followup.send(content, **kw))
+
+async def edit(i, **kw):
+    """edit_message の代わり。自動defer済みなら元メッセージを編集する。"""
+    await _settle(i)
+    if not await _respond_once(i, "edit_message", **kw): await _api(i.edit_original_response(**kw))
+
+async def open_modal(i, modal):
+    """send_modal の代わり。自動deferが先に応答していたらモーダルは出せないので、押し直しを案内する。"""
+    await _settle(i)
+    if not await _respond_once(i, "send_modal", modal):
+        await _api(i.followup.send("⏱ 応答が遅れたため入力画面を開けませんでした。もう一度押してください。", ephemeral=True))
+
+# ================= 2.12. 常設パネルメッセージの再利用 =================
+async def load_panel_message(key):
+    return await db.fetchone("SELECT channel_id, message_id, layout_hash FROM panel_messages WHERE key=?", (key,))
+
+async def save_panel_message(key, channel_id, message_id, layout_hash=None):
+    async with db.write() as conn:
+        await conn.execute("INSERT OR REPLACE INTO panel_messages VALUES (?,?,?,?)", (key, channel_id, message_id, layout_hash))
+
+def layout_hash(title, view):
+    """本文とボタン構成（custom_id・ラベル・行・色）から作るハッシュ。変われば送り直す。"""
+    parts = [title] + [f"{type(c).__name__}|{getattr(c, 'custom_id', '')}|{getattr(c, 'label', '')}|{c.row}|{getattr(c, 'style', '')}"
+                       for c in view.children]
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()[:16]
+
+async def ensure_panel(key, channel, title, view):
+    """保存済みメッセージが残っていてレイアウトも同じなら何もしない。違えば古い方を消して送り直す。
+    ボタンの受付は setup_hook で登録済みの永続Viewが custom_id で引き受ける。"""
+    h = layout_hash(title, view)
+    row = await load_panel_message(key)
+    if row and row[0] == channel.id:
+        try:
+            msg = await channel.fetch_message(row[1])
+            if row[2] == h: return "reused"
+            await msg.delete()
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            # 権限不足・5xx などでは古いメッセージが残っているか分からないので、重複を避けて送らない
+            return f"error {e.status}"
+    try: msg = await channel.send(title, view=view)
+    except discord.HTTPException as e: return f"error {e.status}"
+    await save_panel_message(key, channel.id, msg.id, h)
+    return "sent"
+
+# ================= 2.13. ロール同期ワーカー =================
+class RoleSync:
+    """メンバーごとの「あるべきロール状態」を保持し、バックグラウンドでまとめてDiscordへ反映する。
+    同じメンバーへの要求は反映前なら1件に畳まれ、付与と剥奪は1回のメンバー編集で送る。
+    429を受けたギルドはretry_afterの間まとめて待機する（メンバー編集はギルド単位のレート制限）。"""
+    def __init__(self):
+        self.desired = {}     # (guild_id, member_id) -> {role_id: True/False}
+        self.guilds = {}
+        self.queue = None; self.task = None
+        self._cooldown = {}   # guild_id -> 再開可能なloop時刻
+        self._attempts = {}
+        self.applied = 0; self.coalesced = 0; self.skipped = 0; self.retries = 0; self.failed = 0
+
+    def start(self):
+        if self.task and not self.task.done(): return
+        if self.queue is None: self.queue = asyncio.PriorityQueue()
+        self.task = asyncio.create_task(self._run())
+
+    def request(self, guild, member_id, role_id, on, delay=ROLE_SYNC_DELAY):
+        self.start()
+        key = (guild.id, member_id); self.guilds[guild.id] = guild
+        want = self.desired.get(key)
+        if want is None:
+            want = self.desired[key] = {}
+            self.queue.put_nowait((asyncio.get_running_loop().time() + delay, key))
+        else:
+            self.coalesced += 1
+        want[role_id] = on
+
+    def wants(self, guild_id, member_id, role_id):
+        """未反映の要求があれば True/False、なければ None。"""
+        return self.desired.get((guild_id, member_id), {}).get(role_id)
+
+    def has_role(self, member, guild_id, role_id):
+        w = self.wants(guild_id, member.id, role_id)
+        return any(r.id == role_id for r in member.roles) if w is None else w
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            due, key = await self.queue.get()
+            if key is None: break
+            if (wait := due - loop.time()) > 0: await asyncio.sleep(wait)
+            await self._apply(key)
+
+    async def _apply(self, key):
+        loop = asyncio.get_running_loop()
+        gid, uid = key
+        if (wait := self._cooldown.get(gid, 0) - loop.time()) > 0: await asyncio.sleep(wait)
+        want = self.desired.pop(key, None)
+        guild = self.guilds.get(gid)
+        member = guild.get_member(uid) if guild and want else None
+        if member is None: return
+        have = {r.id for r in member.roles}
+        add = [r for rid, on in want.items() if on and rid not in have and (r := guild.get_role(rid))]
+        rem = [r for rid, on in want.items() if not on and rid in have and (r := guild.get_role(rid))]
+        if not add and not rem:
+            self.skipped += 1; self._attempts.pop(key, None); return
+        try:
+            # atomic=False で付与・剥奪をそれぞれ1回のメンバー編集にまとめる
+            if add: await member.add_roles(*add, atomic=False)
+            if rem: await member.remove_roles(*rem, atomic=False)
+            self.applied += 1; self._attempts.pop(key, None)
+        except discord.Forbidden:
+            self.failed += 1; self._attempts.pop(key, None)
+            print(f"role sync forbidden: {uid}")
+        except discord.HTTPException as e:
+            n = self._attempts[key] = self._attempts.get(key, 0) + 1
+            if n > ROLE_SYNC_RETRIES or e.status < 500 and e.status != 429:
+                self.failed += 1; self._attempts.pop(key, None)
+                return print(f"role sync failed: {uid} {e.status}")
+            retry = float(getattr(e.response, "headers", {}).get("Retry-After", 0) or 0) or 2 ** n
+            if e.status == 429: self._cooldown[gid] = loop.time() + retry
+            # 失敗した要求を戻す（その間に来た新しい要求が優先）
+            if key in self.desired: want.update(self.desired[key])
+            else: self.queue.put_nowait((loop.time() + retry, key))
+            self.desired[key] = want; self.retries += 1
+
+    async def drain(self, timeout=10):
+        """待機中の要求を遅延なしで反映してワーカーを止める（停止・再起動前に呼ぶ）。"""
+        if self.task and not self.task.done(): self.task.cancel()
+        async def flush():
+            while self.desired:
+                for key in list(self.desired): await self._apply(key)
+        try: await asyncio.wait_for(flush(), timeout)
+        except asyncio.TimeoutError: print(f"role sync: {len(self.desired)} pending dropped")
+
+    def stats(self):
+        return (f"pending={len(self.desired)} applied={self.applied} coalesced={self.coalesced} "
+                f"skipped={self.skipped} retries={self.retries} failed={self.failed}")
+
+role_sync = RoleSync()
+
+async def reconcile_work_roles(guilds):
+    """勤務中ロールを未退勤の勤怠と突き合わせ、ずれていれば付与・剥奪を予約する。"""
+    open_ids = {r[0] for r in await db.fetchall("SELECT user_id FROM work_logs WHERE end IS NULL")}
+    n = 0
+    for guild in guilds:
+        if not (role := guild.get_role(WORK_ROLE_ID)): continue
+        holders = {m.id for m in role.members}
+        for uid in holders - open_ids: role_sync.request(guild, uid, WORK_ROLE_ID, False, delay=0); n += 1
+        for uid in open_ids - holders:
+            if guild.get_member(uid): role_sync.request(guild, uid, WORK_ROLE_ID, True, delay=0); n += 1
+    return n
+
+def parse_ids(text):
+    """メンション・カンマ・空白・改行区切りのユーザーIDを順序を保って重複なく取り出す。"""
+    return list(dict.fromkeys(int(x) for x in re.findall(r"\d{15,20}", text)))
+
+def parse_qty(val):
+    try: return int(val)
+    except ValueError: return 0
 
 # ================= 3. 共通UIコンポーネント =================
 class GenericModal(discord.ui.Modal):
-    def __init__(self, title, label, callback):
+    def __init__(self, title, label, callback, style=discord.TextStyle.short):
         super().__init__(title=title)
-        self.input = discord.ui.TextInput(label=label)
+        self.input = discord.ui.TextInput(label=label, style=style)
         self.add_item(self.input)
         self.callback_func = callback
+        self.perf_name = f"Modal:{label}"
     async def on_submit(self, interaction: discord.Interaction):
-        await self.callback_func(interaction, self.input.value)
+        async with perf.measure(self.perf_name, interaction):
+            await self.callback_func(interaction, self.input.value)
+
+class TimedView(discord.ui.View):
+    """全コンポーネントのコールバックを perf.measure で包むView。後から add_item した部品も対象。"""
+    def __init__(self, *, timeout=180):
+        super().__init__(timeout=timeout)
+        for item in self.children: self._wrap(item)
+
+    def add_item(self, item):
+        self._wrap(item)
+        return super().add_item(item)
+
+    def _wrap(self, item):
+        cb = item.callback
+        if getattr(cb, "__perf_wrapped__", False): return
+        fn = getattr(cb, "callback", cb); fname = getattr(fn, "__name__", "")
+        name = f"{type(self).__name__}.{fname}" if fname and not fname.startswith(("_", "<")) and fname not in ("callback", "cb") else \
+               f"{type(self).__name__}:{getattr(item, 'label', None) or getattr(item, 'placeholder', None) or '?'}"
+        async def timed(interaction):
+            async with perf.measure(name, interaction): await cb(interaction)
+        timed.__perf_wrapped__ = True
+        item.callback = timed
+
+def prefix_page(index, prefix, page, size):
+    """昇順リストから前方一致範囲を二分探索し、そのうち1ページ分だけ返す。戻り値: (名前リスト, 該当件数)"""
+    lo = bisect.bisect_left(index, prefix)
+    hi = bisect.bisect_left(index, prefix + "\U0010ffff") if prefix else len(index)
+    start = lo + page * size
+    return index[start:min(hi, start + size)], hi - lo
+
+class PagedPicker:
+    """25件を超える一覧用のセレクト。Viewの指定行にセレクト、その次の行にページ送り・検索ボタンを追加する。
+    index は名前の昇順リストを返す関数、on_pick は (interaction, 名前) を受け取るコルーチン。"""
+    PAGE_SIZE = 25
+
+    def __init__(self, view, index, on_pick, placeholder, label=None, row=0):
+        self.view = view; self.index = index; self.on_pick = on_pick
+        self.placeholder = placeholder; self.label = label or (lambda n: n)
+        self.page = 0; self.prefix = ""
+        self.sel = discord.ui.Select(placeholder=placeholder, row=row)
+        self.prev = discord.ui.Button(label="◀", style=discord.ButtonStyle.gray, row=row + 1)
+        self.next = discord.ui.Button(label="▶", style=discord.ButtonStyle.gray, row=row + 1)
+        self.search = discord.ui.Button(label="🔍 検索", style=discord.ButtonStyle.gray, row=row + 1)
+        self.sel.callback = self._picked; self.prev.callback = self._prev; self.next.callback = self._next
+        self.search.callback = lambda i: open_modal(i, GenericModal("名前で絞り込み", "先頭の文字（空欄で解除）", self._search))
+        for it in (self.sel, self.prev, self.search, self.next): view.add_item(it)
+        self._fill()
+
+    def _fill(self):
+        names, total = prefix_page(self.index(), self.prefix, self.page, self.PAGE_SIZE)
+        pages = max(1, -(-total // self.PAGE_SIZE))
+        self.sel.options = [discord.SelectOption(label=self.label(n)[:100], value=n) for n in names] or [discord.SelectOption(label="該当なし", value="\0")]
+        self.sel.disabled = not names
+        tag = f"「{self.prefix}」 " if self.prefix else ""
+        self.sel.placeholder = f"{self.placeholder} ({tag}{self.page + 1}/{pages})"[:150]
+        self.prev.disabled = self.page == 0; self.next.disabled = self.page + 1 >= pages
+
+    async def _refresh(self, i):
+        self._fill(); await edit(i, view=self.view)
+
+    async def _prev(self, i):
+        self.page = max(0, self.page - 1); await self._refresh(i)
+
+    async def _next(self, i):
+        self.page += 1; await self._refresh(i)
+
+    async def _search(self, i, text):
+        self.prefix = text.strip(); self.page = 0; await self._refresh(i)
+
+    async def _picked(self, i):
+        await self.on_pick(i, self.sel.values[0])
 
 # ================= 4. 商品パネル (ItemPanel) 修正版 =================
-class ItemPanel(discord.ui.View):
+class ItemPanel(TimedView):
     def __init__(self): super().__init__(timeout=None)
     
     async def interaction_check(self, i: discord.Interaction):
         if i.channel_id != ITEM_PANEL_CH: return False
         if any(r.id == ADMIN_ROLE_ID for r in i.user.roles): return True
-        await i.response.send_message("❌ 管理ロールが必要です。", ephemeral=True); return False
+        await reply(i, "❌ 管理ロールが必要です。", ephemeral=True); return False
 
     @discord.ui.button(label="商品・素材マスタ管理", style=discord.ButtonStyle.primary, custom_id="v21_it_master")
     async def reg(self, i, b):
-        async with aiosqlite.connect(DB_PATH) as db:
-            p_rows = await (await db.execute("SELECT name FROM products")).fetchall()
-            m_rows = await (await db.execute("SELECT name FROM materials")).fetchall()
+        await cache.ensure()
         
-        view = discord.ui.View()
+        view = TimedView()
         
         # --- 商品・素材追加（ここは正常動作中） ---
         async def add_p_cb(idx, v):
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute("INSERT OR IGNORE INTO products (name, current, price) VALUES (?, 0, 0)", (v,))
-                await db.commit()
-            await idx.response.send_message(f"✅ 商品【{v}】を登録しました。", ephemeral=True)
+            async with db.write() as conn:
+                await conn.execute("INSERT OR IGNORE INTO products (name, current, price) VALUES (?, 0, 0)", (v,))
+            cache.add_product(v); add_audit(idx.user.id, "商品登録", v)
+            await reply(idx, f"✅ 商品【{v}】を登録しました。", ephemeral=True)
         
         async def add_m_cb(idx, v):
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute("INSERT OR IGNORE INTO materials (name, current) VALUES (?, 0)", (v,))
-                await db.commit()
-            await idx.response.send_message(f"✅ 素材【{v}】を登録しました。", ephemeral=True)
+            async with db.write() as conn:
+                await conn.execute("INSERT OR IGNORE INTO materials (name, current) VALUES (?, 0)", (v,))
+            cache.add_material(v); add_audit(idx.user.id, "素材登録", v)
+            await reply(idx, f"✅ 素材【{v}】を登録しました。", ephemeral=True)
 
         btn_p = discord.ui.Button(label="➕商品追加", style=discord.ButtonStyle.success, row=0)
-        btn_p.callback = lambda x: x.response.send_modal(GenericModal("商品登録", "名前", add_p_cb))
+        btn_p.callback = lambda x: open_modal(x, GenericModal("商品登録", "名前", add_p_cb))
         btn_m = discord.ui.Button(label="➕素材追加", style=discord.ButtonStyle.success, row=0)
-        btn_m.callback = lambda x: x.response.send_modal(GenericModal("素材登録", "名前", add_m_cb))
+        btn_m.callback = lambda x: open_modal(x, GenericModal("素材登録", "名前", add_m_cb))
         view.add_item(btn_p); view.add_item(btn_m)
 
         # --- 商品個別操作プルダウン ---
-        if p_rows:
-            sel_p = discord.ui.Select(placeholder="商品の設定（単価・削除）を選択", row=1)
-            for r in p_rows[:25]: sel_p.add_option(label=f"商品: {r[0]}", value=r[0])
-            
-            async def p_manage_dispatch(i2):
-                target = sel_p.values[0]
+        if cache.product_index:
+            async def p_manage_dispatch(i2, target):
                 # 専用のViewを呼び出す
-                await i2.response.send_message(f"📦 【{target}】の操作を選択してください：", 
+                await reply(i2, f"📦 【{target}】の操作を選択してください：", 
                                              view=ProductControlView(target), ephemeral=True)
-            sel_p.callback = p_manage_dispatch
-            view.add_item(sel_p)
+            PagedPicker(view, lambda: cache.product_index, p_manage_dispatch, "商品の設定（単価・削除）を選択", lambda n: f"商品: {n}", row=1)
 
         # --- 素材削除プルダウン ---
-        if m_rows:
-            sel_m = discord.ui.Select(placeholder="素材を削除する", row=2)
-            for r in m_rows[:25]: sel_m.add_option(label=f"素材削除: {r[0]}", value=r[0])
-            
-            async def m_del_cb(i2):
-                target = sel_m.values[0]
-                async with aiosqlite.connect(DB_PATH) as db:
-                    await db.execute("DELETE FROM materials WHERE name=?", (target,))
-                    await db.execute("DELETE FROM recipes WHERE material_name=?", (target,))
-                    await db.commit()
-                await i2.response.send_message(f"🗑️ 素材【{target}】を削除しました。", ephemeral=True)
-            sel_m.callback = m_del_cb
-            view.add_item(sel_m)
-
-        await i.response.send_message("⚙️ **マスタ管理メニュー**", view=view, ephemeral=True)
+        if cache.material_index:
+            async def m_del_cb(i2, target):
+                async with db.write() as conn:
+                    await conn.execute("DELETE FROM materials WHERE name=?", (target,))   # レシピ行は外部キーで連動削除
+                cache.drop_material(target); add_audit(i2.user.id, "素材削除", target)
+                await reply(i2, f"🗑️ 素材【{target}】を削除しました。", ephemeral=True)
+            PagedPicker(view, lambda: cache.material_index, m_del_cb, "素材を削除する", lambda n: f"素材削除: {n}", row=3)
+
+        await reply(i, "⚙️ **マスタ管理メニュー**", view=view, ephemeral=True)
 
     # 3. 素材補充・引き出し
     @discord.ui.button(label="素材補充・引き出し", style=discord.ButtonStyle.secondary, custom_id="v19_it_m_adj")
     async def mat_adj(self, i, b):
-        async with aiosqlite.connect(DB_PATH) as db:
-            mats = await (await db.execute("SELECT name, current FROM materials")).fetchall()
+        await cache.ensure()
         
-        if not mats: return await i.response.send_message("❌ 素材が登録されていません。", ephemeral=True)
+        if not cache.material_index: return await reply(i, "❌ 素材が登録されていません。", ephemeral=True)
         
-        view = discord.ui.View(); sel = discord.ui.Select(placeholder="対象の素材を選択")
-        for r in mats[:25]: sel.add_option(label=f"{r[0]} (現在: {r[1]}個)", value=r[0])
+        def on_pick(i2, target):
+            async def adj_cb(i3, val):
+                async with db.write() as conn:
+                    await conn.execute("UPDATE materials SET current = current + ? WHERE name=?", (int(val), target))
+                cache.adjust_material(target, int(val)); add_audit(i3.user.id, "在庫調整", f"{target} {int(val):+d}")
+                await reply(i3, f"✅ {target} を {val} 個調整しました。", ephemeral=True)
+            return open_modal(i2, GenericModal("在庫調整", "+で補充 / -で減少", adj_cb))
         
-        async def adj_cb(i2, val):
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute("UPDATE materials SET current = current + ? WHERE name=?", (int(val), sel.values[0]))
-                await db.commit()
-            await i2.response.send_message(f"✅ {sel.values[0]} を {val} 個調整しました。", ephemeral=True)
-            
-        sel.callback = lambda i2: i2.response.send_modal(GenericModal("在庫調整", "+で補充 / -で減少", adj_cb))
-        view.add_item(sel); await i.response.send_message("📦 **素材在庫の直接調整**", view=view, ephemeral=True)
+        view = TimedView()
+        PagedPicker(view, lambda: cache.material_index, on_pick, "対象の素材を選択", lambda n: f"{n} (現在: {cache.materials[n].current}個)")
+        await reply(i, "📦 **素材在庫の直接調整**", view=view, ephemeral=True)
 
     # 4. 在庫表示
     @discord.ui.button(label="在庫表示", style=discord.ButtonStyle.gray, custom_id="v19_it_stock")
     async def stock_view(self, i, b):
-        async with aiosqlite.connect(DB_PATH) as db:
-            m = await (await db.execute("SELECT name, current FROM materials")).fetchall()
-            p = await (await db.execute("SELECT name, current FROM products")).fetchall()
-        
-        txt = "📦 **現在庫一覧**\n\n**【商品（制作済み）】**\n"
-        txt += ("\n".join([f"・{x[0]}: `{x[1]}`個 (単価:{x[2] if len(x)>2 else 0}円)" for x in p]) if p else "なし")
-        txt += "\n\n**【素材（原材料）】**\n"
-        txt += ("\n".join([f"・{x[0]}: `{x[1]}`個" for x in m]) if m else "なし")
-        await i.response.send_message(txt, ephemeral=True)
+        # 常設ダッシュボードと同じ描画を使う（キャッシュのみ参照・サイズ上限内）
+        await cache.ensure()
+        if dashboard.messages: return await reply(i, "📦 在庫はこのチャンネルの在庫ダッシュボードで常時更新されています。", ephemeral=True)
+        for s in dashboard.SECTIONS: dashboard._recompute(s, None)
+        # embed合計の上限があるため区分ごとに別メッセージで返す
+        await reply(i, "📦 **現在庫一覧**", embeds=dashboard.embeds("products"), ephemeral=True)
+        await _api(i.followup.send(embeds=dashboard.embeds("materials"), ephemeral=True))
+
+    # 5. 一括インポート・エクスポート
+    @discord.ui.button(label="一括入出力", style=discord.ButtonStyle.gray, custom_id="v23_it_bulk")
+    async def bulk_io(self, i, b):
+        await reply(i, "📂 **一括インポート / エクスポート**\n"
+            "インポート: このチャンネルで `!import` にCSV/JSONファイルを添付して送信（確認後に適用）\n"
+            "列: `type,name,price,current,material,part,quantity`（type は product / material / recipe / part。part は中間商品）\n"
+            "エクスポート: 下のボタン、または `!export stock|work|sales [YYYY-MM]`", view=ExportView(), ephemeral=True)
+
+# ================= 4.4. 一括入出力用サブView =================
+class ExportView(TimedView):
+    def __init__(self):
+        super().__init__(timeout=180)
+        for kind, label in EXPORT_KINDS.items():
+            btn = discord.ui.Button(label=f"📤 {label}CSV（今月）" if kind != "stock" else f"📤 {label}CSV", style=discord.ButtonStyle.secondary)
+            btn.callback = self._make_cb(kind); self.add_item(btn)
+
+    @staticmethod
+    def _make_cb(kind):
+        async def cb(i):
+            month = None if kind == "stock" else f"{datetime.now():%Y-%m}"
+            await reply(i, file=await export_csv(kind, month), ephemeral=True)
+        return cb
+
+class ImportConfirmView(TimedView):
+    def __init__(self, plan, author_id):
+        super().__init__(timeout=300)
+        self.plan = plan; self.author_id = author_id
+
+    async def interaction_check(self, i: discord.Interaction):
+        return i.user.id == self.author_id
+
+    @discord.ui.button(label="✅ 適用する", style=discord.ButtonStyle.success)
+    async def apply_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        self.stop()
+        try:
+            await apply_import(self.plan, i.user.id)
+        except aiosqlite.IntegrityError:
+            # 確認から適用までの間に、レシピが参照する商品・素材が削除された（外部キー違反で全体が巻き戻る）
+            return await edit(i, content="❌ 確認後にマスタが変更されたため適用できませんでした（何も変更していません）。もう一度 `!import` からやり直してください。", view=None)
+        await edit(i, content="✅ インポートを適用しました。\n" + self.plan.diff_text(), view=None)
+
+    @discord.ui.button(label="キャンセル", style=discord.ButtonStyle.secondary)
+    async def cancel_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        self.stop()
+        await edit(i, content="インポートを中止しました。", view=None)
 
 # ================= 4.5. 商品個別操作用サブView =================
-class ProductControlView(discord.ui.View):
+class ProductControlView(TimedView):
     def __init__(self, target_product: str):
         super().__init__(timeout=180)
         self.target = target_product
@@ -174,228 +1685,451 @@ class ProductControlView(discord.ui.View):
         async def set_p_final(idx, val):
             try:
                 price_val = int(val)
-                async with aiosqlite.connect(DB_PATH) as db:
-                    await db.execute("UPDATE products SET price=? WHERE name=?", (price_val, self.target))
-                    await db.commit()
-                await idx.response.send_message(f"✅ {self.target} の単価を {price_val}円 に設定しました。", ephemeral=True)
+                async with db.write() as conn:
+                    await conn.execute("UPDATE products SET price=? WHERE name=?", (price_val, self.target))
+                cache.set_price(self.target, price_val); add_audit(idx.user.id, "単価設定", f"{self.target} {price_val}円")
+                await reply(idx, f"✅ {self.target} の単価を {price_val}円 に設定しました。", ephemeral=True)
             except ValueError:
-                await idx.response.send_message("❌ 半角数字で入力してください。", ephemeral=True)
+                await reply(idx, "❌ 半角数字で入力してください。", ephemeral=True)
         
-        await i.response.send_modal(GenericModal(f"{self.target}の単価設定", "金額を入力", set_p_final))
+        await open_modal(i, GenericModal(f"{self.target}の単価設定", "金額を入力", set_p_final))
 
     @discord.ui.button(label="❌ 商品を削除", style=discord.ButtonStyle.danger)
     async def delete_prod(self, i: discord.Interaction, b: discord.ui.Button):
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("DELETE FROM products WHERE name=?", (self.target,))
-            await db.execute("DELETE FROM recipes WHERE product_name=?", (self.target,))
-            await db.commit()
-        await i.response.send_message(f"🗑️ 商品【{self.target}】をマスタから削除しました。", ephemeral=True)
+        async with db.write() as conn:
+            await conn.execute("DELETE FROM products WHERE name=?", (self.target,))   # レシピ行は外部キーで連動削除
+        cache.drop_product(self.target); add_audit(i.user.id, "商品削除", self.target)
+        await reply(i, f"🗑️ 商品【{self.target}】をマスタから削除しました。", ephemeral=True)
 
     # 2. レシピボタン（制作時の素材・個数設定）
     @discord.ui.button(label="レシピ設定", style=discord.ButtonStyle.success, custom_id="v19_it_recipe")
     async def recipe(self, i, b):
-        async with aiosqlite.connect(DB_PATH) as db:
-            prods = await (await db.execute("SELECT name FROM products")).fetchall()
-            mats = await (await db.execute("SELECT name FROM materials")).fetchall()
+        await cache.ensure()
         
-        if not prods or not mats: return await i.response.send_message("❌ 商品と素材の両方を登録してください。", ephemeral=True)
+        if not cache.product_index or not cache.material_index: return await reply(i, "❌ 商品と素材の両方を登録してください。", ephemeral=True)
         
-        view = discord.ui.View(); sel_p = discord.ui.Select(placeholder="レシピを設定する商品を選択")
-        for r in prods[:25]: sel_p.add_option(label=f"商品: {r[0]}", value=r[0])
-        
-        async def p_sel_cb(i2):
-            target_p = sel_p.values[0]; v2 = discord.ui.View()
-            sel_m = discord.ui.Select(placeholder=f"{target_p} に使う素材を選択")
-            for r in mats[:25]: sel_m.add_option(label=f"素材: {r[0]}", value=r[0])
-            
-            async def r_final(i3, qty):
-                async with aiosqlite.connect(DB_PATH) as db:
-                    await db.execute("INSERT OR REPLACE INTO recipes VALUES (?,?,?)", (target_p, sel_m.values[0], int(qty)))
-                    await db.commit()
-                await i3.response.send_message(f"✅ {target_p} 1個につき {sel_m.values[0]} を {qty}個 使用するように設定しました。", ephemeral=True)
+        async def p_sel_cb(i2, target_p):
+            def part_sel_cb(i4, target_c):
+                async def c_final(i3, qty):
+                    # 0 は「外す」なので、打ち間違い（数字以外・負数）を0扱いにせず断る
+                    if not qty.strip().isdigit(): return await reply(i3, "❌ 0以上の半角数字で入力してください（0で外す）。", ephemeral=True)
+                    q = int(qty)
+                    if q > 0 and (target_c == target_p or cache.would_cycle(target_p, target_c)):
+                        return await reply(i3, f"❌ {target_c} は {target_p} を材料にしているため、循環するレシピになります。", ephemeral=True)
+                    async with db.write() as conn:
+                        if q > 0: await conn.execute("INSERT OR REPLACE INTO recipe_parts VALUES (?,?,?)", (target_p, target_c, q))
+                        else: await conn.execute("DELETE FROM recipe_parts WHERE product_name=? AND part_name=?", (target_p, target_c))
+                    cache.set_part(target_p, target_c, q); add_audit(i3.user.id, "レシピ設定", f"{target_p} ← {target_c}(中間) x{q}")
+                    await reply(i3, f"✅ {target_p} 1個につき 中間商品 {target_c} を {q}個 使用するように設定しました。" if q > 0
+                                else f"✅ {target_p} のレシピから {target_c} を外しました。", ephemeral=True)
+                return open_modal(i4, GenericModal("個数設定", "1個制作に必要な数（0で外す）", c_final))
+
+            def m_sel_cb(i4, target_m):
+                async def r_final(i3, qty):
+                    q = parse_qty(qty)
+                    if q <= 0: return await reply(i3, "❌ 1以上の半角数字で入力してください。", ephemeral=True)
+                    async with db.write() as conn:
+                        await conn.execute("INSERT OR REPLACE INTO recipes VALUES (?,?,?)", (target_p, target_m, q))
+                    cache.set_recipe(target_p, target_m, q); add_audit(i3.user.id, "レシピ設定", f"{target_p} ← {target_m} x{q}")
+                    await reply(i3, f"✅ {target_p} 1個につき {target_m} を {q}個 使用するように設定しました。", ephemeral=True)
+                return open_modal(i4, GenericModal("個数設定", "1個制作に必要な数", r_final))
             
-            sel_m.callback = lambda i4: i4.response.send_modal(GenericModal("個数設定", "1個制作に必要な数", r_final))
-            v2.add_item(sel_m); await i2.response.send_message(f"【{target_p}】の素材を指定：", view=v2, ephemeral=True)
+            v2 = TimedView()
+            PagedPicker(v2, lambda: cache.material_index, m_sel_cb, f"{target_p} に使う素材を選択", lambda n: f"素材: {n}")
+            PagedPicker(v2, lambda: [n for n in cache.product_index if n != target_p], part_sel_cb, f"{target_p} に使う中間商品を選択", lambda n: f"中間商品: {n}", row=2)
+            await reply(i2, f"【{target_p}】の素材・中間商品を指定：", view=v2, ephemeral=True)
         
-        sel_p.callback = p_sel_cb; view.add_item(sel_p)
-        await i.response.send_message("📜 **レシピ設定（制作報告と連動）**", view=view, ephemeral=True)
+        view = TimedView()
+        PagedPicker(view, lambda: cache.product_index, p_sel_cb, "レシピを設定する商品を選択", lambda n: f"商品: {n}")
+        await reply(i, "📜 **レシピ設定（制作報告と連動）**", view=view, ephemeral=True)
 
 # ================= 5. 管理パネル (AdminPanel) 修正版 =================
-class AdminPanel(discord.ui.View):
+class AdminPanel(TimedView):
     def __init__(self): super().__init__(timeout=None)
     
     async def interaction_check(self, i: discord.Interaction):
         if i.channel_id != ADMIN_PANEL_CH: return False
         if any(r.id == ADMIN_ROLE_ID for r in i.user.roles): return True
-        await i.response.send_message("❌ 管理ロールが必要です。", ephemeral=True); return False
+        await reply(i, "❌ 管理ロールが必要です。", ephemeral=True); return False
 
     @discord.ui.button(label="メンバー管理", style=discord.ButtonStyle.success, custom_id="v16_ad_mem")
     async def members(self, i, b):
-        view = discord.ui.View(); sel = discord.ui.Select(placeholder="付与するロールを選択")
+        view = TimedView(); sel = discord.ui.Select(placeholder="付与するロールを選択")
         for n, rid in ROLE_OPTIONS.items(): sel.add_option(label=n, value=str(rid))
         async def m_cb(i2):
-            async def act(i3, uid):
-                target = i3.guild.get_member(int(uid)); role = i3.guild.get_role(int(sel.values[0]))
-                if target and role: await target.add_roles(role); await i3.response.send_message(f"✅ {target.display_name} に付与完了", ephemeral=True)
-                else: await i3.response.send_message("❌ ユーザーまたはロールが見つかりません。", ephemeral=True)
-            await i2.response.send_modal(GenericModal("ID入力", "ユーザーID", act))
-        sel.callback = m_cb; view.add_item(sel); await i.response.send_message("ロール管理:", view=view, ephemeral=True)
+            async def act(i3, text):
+                # 複数IDを貼り付け可。付与はワーカーがまとめて反映する
+                role = i3.guild.get_role(int(sel.values[0])); ids = parse_ids(text)
+                found = [uid for uid in ids if i3.guild.get_member(uid)]; missing = [uid for uid in ids if uid not in found]
+                if not role or not found: return await reply(i3, "❌ ユーザーまたはロールが見つかりません。", ephemeral=True)
+                for uid in found: role_sync.request(i3.guild, uid, role.id, True, delay=0)
+                add_audit(i3.user.id, "ロール付与", f"{role.name} " + " ".join(f"<@{uid}>" for uid in found))
+                msg = f"✅ {len(found)}名に {role.name} の付与を受け付けました。"
+                if missing: msg += "\n⚠️ 見つからないID: " + ", ".join(map(str, missing))
+                await reply(i3, msg, ephemeral=True)
+            await open_modal(i2, GenericModal("ID入力", "ユーザーID（複数可・改行/空白区切り）", act, style=discord.TextStyle.paragraph))
+        sel.callback = m_cb; view.add_item(sel); await reply(i, "ロール管理:", view=view, ephemeral=True)
 
     @discord.ui.button(label="集計/データリセット", style=discord.ButtonStyle.gray, custom_id="v22_ad_stat")
     async def stats(self, i: discord.Interaction, b: discord.ui.Button):
-        async with aiosqlite.connect(DB_PATH) as db:
-            rank = await (await db.execute("SELECT user_id, total_amount FROM sales_ranking ORDER BY total_amount DESC")).fetchall()
-            work = await (await db.execute("SELECT user_id, SUM(duration) FROM work_logs GROUP BY user_id")).fetchall()
-        
-        msg = "🏆 **売上ランキング**\n" + ("\n".join([f"<@{r[0]}>: {r[1]:,}円" for r in rank]) if rank else "データなし")
-        msg += f"\n\n📊 **勤怠累計**\n" + ("\n".join([f"<@{w[0]}>: {w[1]//60}時間{w[1]%60}分" for w in work]) if work else "データなし")
-        
-        # リセット専用のViewを呼び出すことで動作を確定させる
-        await i.response.send_message(msg, view=DataResetView(), ephemeral=True)
+        # ページ送り付きの集計View（リセットボタンも含む）
+        view = StatsView()
+        await reply(i, await view.render(), view=view, ephemeral=True)
 
     @discord.ui.button(label="履歴ログ", style=discord.ButtonStyle.gray, custom_id="v16_ad_log")
     async def logs(self, i, b):
-        async with aiosqlite.connect(DB_PATH) as db:
-            rows = await (await db.execute("SELECT created_at, user_id, action, detail FROM audit_logs ORDER BY id DESC LIMIT 15")).fetchall()
-        txt = "📜 **履歴ログ**\n" + ("\n".join([f"`{r[0][5:16]}` <@{r[1]}> **{r[2]}**: {r[3]}" for r in rows]) if rows else "ログなし")
-        await i.response.send_message(txt, ephemeral=True)
+        rows = await db.fetchall("SELECT created_at, user_id, action, detail FROM audit_logs ORDER BY id DESC LIMIT 15")
+        txt = "📜 **履歴ログ**\n" + ("\n".join([f"`{datetime.fromtimestamp(r[0]):%m-%d %H:%M}` <@{r[1]}> **{r[2]}**: {r[3]}" for r in rows]) if rows else "ログなし")
+        await reply(i, txt, ephemeral=True)
+
+    @discord.ui.button(label="📈 期間分析", style=discord.ButtonStyle.primary, custom_id="v24_ad_analytics")
+    async def analytics(self, i, b):
+        view = AnalyticsView()
+        await reply(i, await view.render(i), view=view, ephemeral=True)
+
+    @discord.ui.button(label="⏱ 性能レポート", style=discord.ButtonStyle.gray, custom_id="v23_ad_perf")
+    async def perf_report(self, i, b):
+        perf.dump()
+        await reply(i, perf.report() + f"\nロール同期: {role_sync.stats()}", ephemeral=True)
 
 # ================= 4.6. リセット操作専用View =================
-class DataResetView(discord.ui.View):
+class DataResetView(TimedView):
+    """リセットは期間締め。履歴は消さずに新しい期間の開始日（明日）を記録する。
+    日次集計は日単位なので、締めた日の分はすべて前期に入り、今期は空から始まる（旧リセットと同じ見え方）。"""
     def __init__(self):
         super().__init__(timeout=180)
 
-    @discord.ui.button(label="⚠️ 全体リセット", style=discord.ButtonStyle.danger)
-    async def reset_all_btn(self, i: discord.Interaction, b: discord.ui.Button):
-        # 誤操作防止の確認などは入れず、即時実行します
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("DELETE FROM sales_ranking")
-            await db.execute("DELETE FROM work_logs")
-            await db.commit()
-        await i.response.send_message("✅ 全員の売上・勤怠データをリセットしました。", ephemeral=True)
-
-    @discord.ui.button(label="👤 個人リセット", style=discord.ButtonStyle.secondary)
-    async def reset_ind_btn(self, i: discord.Interaction, b: discord.ui.Button):
-        async def reset_ind_callback(idx, uid):
+    @discord.ui.button(label="🔒 全体締め", style=discord.ButtonStyle.danger)
+    async def close_all_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        today = day_key(int(time.time())); start = next_day_key(); prev = await period_start()
+        if prev >= start: return await reply(i, f"❌ 本日までの分は既に締めています（今期は {prev} から）。", ephemeral=True)
+        sales = sum(r[1] for r in await range_totals("sales_user", prev, today, period=True))
+        work = sum(r[1] for r in await range_totals("work", prev, today, period=True))
+        async with db.write() as conn:
+            await conn.execute("INSERT INTO period_closes (user_id, day, closed_by, closed_at) VALUES (NULL,?,?,?)", (start, i.user.id, int(time.time())))
+        add_audit(i.user.id, "期間締め", f"全体 {prev or '開始'}〜{today}")
+        await reply(i, f"✅ {today} までで締めました（前期: 売上 {sales:,}円 / 勤怠 {fmt_minutes(work)}）。\n"
+                       f"今期の集計は {start} から始まります。過去の記録は期間分析で参照できます。", ephemeral=True)
+
+    @discord.ui.button(label="👤 個人締め", style=discord.ButtonStyle.secondary)
+    async def close_ind_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        async def close_ind_callback(idx, uid):
             try:
                 target_uid = int(uid)
-                async with aiosqlite.connect(DB_PATH) as db:
-                    await db.execute("DELETE FROM sales_ranking WHERE user_id=?", (target_uid,))
-                    await db.execute("DELETE FROM work_logs WHERE user_id=?", (target_uid,))
-                    await db.commit()
-                await idx.response.send_message(f"✅ 指定ユーザー(<@{target_uid}>)のデータをリセットしました。", ephemeral=True)
+                async with db.write() as conn:
+                    await conn.execute("INSERT INTO period_closes (user_id, day, closed_by, closed_at) VALUES (?,?,?,?)",
+                                       (target_uid, next_day_key(), idx.user.id, int(time.time())))
+                add_audit(idx.user.id, "期間締め", f"個人 <@{target_uid}>")
+                await reply(idx, f"✅ 指定ユーザー(<@{target_uid}>)を本日までで締め、今期集計を {next_day_key()} から始めます。", ephemeral=True)
             except ValueError:
-                await idx.response.send_message("❌ 正しいユーザーID（数字）を入力してください。", ephemeral=True)
+                await reply(idx, "❌ 正しいユーザーID（数字）を入力してください。", ephemeral=True)
+
+        await open_modal(i, GenericModal("個人の期間締め", "対象のユーザーIDを入力", close_ind_callback))
+
+# ================= 4.7. 集計表示View（ページ送り） =================
+STATS_PAGE_SIZE = 15
+STATS_PERIODS = {**TOTAL_BUCKETS, "period": ANALYTICS_PRESETS["period"]}
+
+class StatsView(DataResetView):
+    def __init__(self):
+        super().__init__()
+        self.kind = "all"; self.page = 0; self.has_next = False
 
-        await i.response.send_modal(GenericModal("個人データリセット", "対象のユーザーIDを入力", reset_ind_callback))
+    async def render(self):
+        off = self.page * STATS_PAGE_SIZE
+        if self.kind == "period":
+            d0, d1 = await preset_range("period")
+            rank = await range_totals("sales_user", d0, d1, off, STATS_PAGE_SIZE + 1, period=True)
+            work = await range_totals("work", d0, d1, off, STATS_PAGE_SIZE + 1, period=True)
+        else:
+            rank = await top_totals(self.kind, "sales", off, STATS_PAGE_SIZE)
+            work = await top_totals(self.kind, "work", off, STATS_PAGE_SIZE)
+        self.has_next = len(rank) > STATS_PAGE_SIZE or len(work) > STATS_PAGE_SIZE
+        rank = rank[:STATS_PAGE_SIZE]; work = work[:STATS_PAGE_SIZE]
+        self.prev_btn.disabled = self.page == 0; self.next_btn.disabled = not self.has_next
+
+        head = f"📅 **{STATS_PERIODS[self.kind]}** (ページ {self.page + 1})\n\n"
+        msg = head + "🏆 **売上ランキング**\n" + ("\n".join([f"{off+n}. <@{r[0]}>: {r[1]:,}円" for n, r in enumerate(rank, 1)]) if rank else "データなし")
+        msg += f"\n\n📊 **勤怠累計**\n" + ("\n".join([f"{off+n}. <@{w[0]}>: {w[1]//60}時間{w[1]%60}分" for n, w in enumerate(work, 1)]) if work else "データなし")
+        return msg
+
+    async def _refresh(self, i):
+        await edit(i, content=await self.render(), view=self)
+
+    @discord.ui.select(placeholder="集計期間を選択", options=[discord.SelectOption(label=v, value=k) for k, v in STATS_PERIODS.items()], row=1)
+    async def period_sel(self, i: discord.Interaction, s: discord.ui.Select):
+        self.kind = s.values[0]; self.page = 0
+        await self._refresh(i)
+
+    @discord.ui.button(label="◀ 前へ", style=discord.ButtonStyle.gray, row=2)
+    async def prev_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await self._refresh(i)
+
+    @discord.ui.button(label="次へ ▶", style=discord.ButtonStyle.gray, row=2)
+    async def next_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        if self.has_next: self.page += 1
+        await self._refresh(i)
+
+# ================= 4.8. 期間分析View =================
+ANALYTICS_ROWS = 25
+
+class AnalyticsView(TimedView):
+    """日次ロールアップから任意期間の表とグラフを出す。"""
+    def __init__(self):
+        super().__init__(timeout=300)
+        self.report = "work"; self.preset = "w"; self.range = None
+
+    async def _range(self):
+        return self.range or await preset_range(self.preset)
+
+    def _label(self, i, key):
+        if self.report == "sales_product": return key
+        m = i.guild.get_member(key) if i.guild else None
+        return m.display_name if m else str(key)
+
+    async def render(self, i):
+        d0, d1 = await self._range(); period = self.range is None and self.preset == "period"
+        rows = await range_totals(self.report, d0, d1, period=period)
+        head = f"📈 **{ANALYTICS_REPORTS[self.report]}** {d0 or '開始'}〜{d1}"
+        if not rows: return head + "\nデータなし"
+        if self.report == "work":
+            body = text_table(("#", "名前", "勤怠"), [(n, self._label(i, k), fmt_minutes(v)) for n, (k, v, _) in enumerate(rows[:ANALYTICS_ROWS], 1)], "<<>")
+            total = f"合計 {fmt_minutes(sum(r[1] for r in rows))}"
+        else:
+            body = text_table(("#", "名前", "数量", "金額"), [(n, self._label(i, k), f"{q:,}", f"{v:,}円") for n, (k, v, q) in enumerate(rows[:ANALYTICS_ROWS], 1)], "<<>>")
+            total = f"合計 {sum(r[2] for r in rows):,}個 / {sum(r[1] for r in rows):,}円"
+        more = f"（上位{ANALYTICS_ROWS}件 / 全{len(rows)}件）" if len(rows) > ANALYTICS_ROWS else ""
+        return f"{head}\n```\n{body}\n```\n{total}{more}"
+
+    async def _refresh(self, i):
+        await edit(i, content=await self.render(i), view=self)
+
+    @discord.ui.select(placeholder="集計の種類", options=[discord.SelectOption(label=v, value=k) for k, v in ANALYTICS_REPORTS.items()], row=0)
+    async def report_sel(self, i: discord.Interaction, s: discord.ui.Select):
+        self.report = s.values[0]
+        await self._refresh(i)
+
+    @discord.ui.select(placeholder="期間", options=[discord.SelectOption(label=v, value=k) for k, v in ANALYTICS_PRESETS.items()], row=1)
+    async def preset_sel(self, i: discord.Interaction, s: discord.ui.Select):
+        self.preset = s.values[0]; self.range = None
+        await self._refresh(i)
+
+    @discord.ui.button(label="📅 期間指定", style=discord.ButtonStyle.gray, row=2)
+    async def range_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        async def on_range(i2, text):
+            try: self.range = parse_range(text)
+            except ValueError: return await reply(i2, "❌ YYYY-MM-DD YYYY-MM-DD / YYYY-MM-DD / YYYY-MM のいずれかで入力してください。", ephemeral=True)
+            await reply(i2, await self.render(i2), view=self, ephemeral=True)
+        await open_modal(i, GenericModal("期間指定", "期間 (例: 2026-10-01 2026-10-31)", on_range))
+
+    @discord.ui.button(label="📊 日別グラフ", style=discord.ButtonStyle.primary, row=2)
+    async def chart_btn(self, i: discord.Interaction, b: discord.ui.Button):
+        d0, d1 = await self._range(); period = self.range is None and self.preset == "period"
+        series = await daily_series(self.report, d0, d1, period=period)
+        if len(series) > CHART_MAX_DAYS: return await reply(i, f"❌ グラフは{CHART_MAX_DAYS}日以内で指定してください。", ephemeral=True)
+        if not series: return await reply(i, "📊 この期間の記録はまだありません（締めた直後の今期は翌日から集計されます）。", ephemeral=True)
+        vals = [v for _, v in series]; peak = max(vals, default=0)
+        unit = fmt_minutes(peak) if self.report == "work" else f"{peak:,}円"
+        png = await asyncio.to_thread(bar_chart_png, vals)
+        await reply(i, f"📊 {ANALYTICS_REPORTS[self.report]} 日別 {series[0][0]}〜{series[-1][0]}（{len(series)}日, 最大 {unit}/日）",
+                    file=discord.File(io.BytesIO(png), "chart.png"), ephemeral=True)
 
 # ================= 6. 業務パネル (GeneralPanel) =================
-class GeneralPanel(discord.ui.View):
+class GeneralPanel(TimedView):
     def __init__(self): super().__init__(timeout=None)
     
     @discord.ui.button(label="🟢 出勤/🔴 退勤", style=discord.ButtonStyle.success, custom_id="v15_gen_work")
     async def work(self, i, b):
         if not any(r.id == OMNIS_ROLE_ID for r in i.user.roles):
-            return await i.response.send_message("❌ オムニス商会ロールが必要です。", ephemeral=True)
+            return await reply(i, "❌ オムニス商会ロールが必要です。", ephemeral=True)
         
-        now = datetime.now()
-        async with aiosqlite.connect(DB_PATH) as db:
-            active = await (await db.execute("SELECT start FROM work_logs WHERE user_id=? AND end IS NULL", (i.user.id,))).fetchone()
+        now = int(time.time())
+        # 書き込みロックはDB操作の間だけ保持し、ロール変更・応答はコミット後に行う
+        async with db.write() as conn:
+            active = await (await conn.execute("SELECT start FROM work_logs WHERE user_id=? AND end IS NULL", (i.user.id,))).fetchone()
             if not active:
-                await db.execute("INSERT INTO work_logs (user_id, start) VALUES (?,?)", (i.user.id, now))
-                await i.user.add_roles(i.guild.get_role(WORK_ROLE_ID))
-                await i.response.send_message("🟢 出勤しました。", ephemeral=True)
+                await conn.execute("INSERT INTO work_logs (user_id, start) VALUES (?,?)", (i.user.id, now))
             else:
-                diff = int((now - datetime.strptime(active[0], "%Y-%m-%d %H:%M:%S.%f")).total_seconds() // 60)
-                await db.execute("UPDATE work_logs SET end=?, duration=? WHERE user_id=? AND end IS NULL", (now, diff, i.user.id))
-                await i.user.remove_roles(i.guild.get_role(WORK_ROLE_ID))
-                # 匿名メッセージ（ephemeral=True）
-                await i.response.send_message(f"🔴 退勤しました。勤務時間: {diff//60}時間{diff%60}分", ephemeral=True)
-            await db.commit()
+                diff = (now - active[0]) // 60
+                await conn.execute("UPDATE work_logs SET end=?, duration=? WHERE user_id=? AND end IS NULL", (now, diff, i.user.id))
+                await bump_totals(conn, i.user.id, now, work=diff)
+                await bump_daily_work(conn, i.user.id, active[0], now)
+        # 勤務中ロールの付与・剥奪はワーカーに任せ、応答はコミット直後に返す
+        role_sync.request(i.guild, i.user.id, WORK_ROLE_ID, not active)
+        if not active:
+            await reply(i, "🟢 出勤しました。", ephemeral=True)
+        else:
+            # 匿名メッセージ（ephemeral=True）
+            await reply(i, f"🔴 退勤しました。勤務時間: {diff//60}時間{diff%60}分", ephemeral=True)
 
     @discord.ui.button(label="🛠 制作報告", style=discord.ButtonStyle.primary, custom_id="v15_gen_craft")
     async def craft(self, i, b):
-        if not any(r.id == WORK_ROLE_ID for r in i.user.roles): return await i.response.send_message("❌ 出勤中のみ可能です。", ephemeral=True)
-        async with aiosqlite.connect(DB_PATH) as db:
-            prods = [r[0] for r in await (await db.execute("SELECT name FROM products")).fetchall()]
-        if not prods: return await i.response.send_message("❌ 商品が未登録です。", ephemeral=True)
+        if not role_sync.has_role(i.user, i.guild.id, WORK_ROLE_ID): return await reply(i, "❌ 出勤中のみ可能です。", ephemeral=True)
+        await cache.ensure()
+        if not cache.product_index: return await reply(i, "❌ 商品が未登録です。", ephemeral=True)
         
-        v = discord.ui.View(); sel = discord.ui.Select(placeholder="制作した商品を選択")
-        for p in prods: sel.add_option(label=p, value=p)
+        # 選択肢には今の在庫で作れる最大数を出し、作れない数はDBに問い合わせる前に断る
+        def label(n):
+            k = cache.max_craftable(n)
+            return f"{n} (レシピ未設定)" if k is None else f"{n} (制作可能: {k:,})"
+
+        def short_text(shortfalls, target):
+            lines = "\n".join(f"・{mn} (必要: {need}, 現在: {cur})" for mn, need, cur in shortfalls)
+            return (f"❌ 素材不足:\n{lines}" if lines else "❌ 素材不足のため制作できませんでした。") + f"\n（今の在庫で最大 {cache.max_craftable(target) or 0:,} 個）"
+
+        def on_pick(i2, target):
+            k = cache.max_craftable(target)
+            if k is None: return reply(i2, f"❌ {target} のレシピが設定されていません。", ephemeral=True)
+            if k == 0: return reply(i2, short_text(cache.bom(target, 1)[3], target), ephemeral=True)
+            return open_modal(i2, GenericModal("制作数", f"制作した個数（半角数字・最大 {k:,}）", lambda i3, q: cb(i3, target, q)))
         
-        async def cb(i2, q):
-            q = int(q)
-            async with aiosqlite.connect(DB_PATH) as db:
-                recipe = await (await db.execute("SELECT material_name, quantity FROM recipes WHERE product_name=?", (sel.values[0],))).fetchall()
-                if not recipe: return await i2.response.send_message(f"❌ {sel.values[0]} のレシピが設定されていません。", ephemeral=True)
-                
-                # 在庫チェック
-                for mn, mq in recipe:
-                    cur = await (await db.execute("SELECT current FROM materials WHERE name=?", (mn,))).fetchone()
-                    if not cur or cur[0] < (mq * q): return await i2.response.send_message(f"❌ 素材不足: {mn} (必要: {mq*q}, 現在: {cur[0] if cur else 0})", ephemeral=True)
-                
-                # 在庫変動
-                for mn, mq in recipe: await db.execute("UPDATE materials SET current = current - ? WHERE name=?", (mq * q, mn))
-                await db.execute("UPDATE products SET current = current + ? WHERE name=?", (q, sel.values[0]))
-                await db.commit()
-            
-            await add_audit(i2.user.id, "制作", f"{sel.values[0]} x{q}")
-            await i2.response.send_message(f"✅ {sel.values[0]} を {q} 個制作しました（素材を自動消費）。", ephemeral=True)
+        async def cb(i2, target, q):
+            q = parse_qty(q)
+            res = await craft_product(i2.user.id, target, q)
+            if res.error == "bad_qty": return await reply(i2, "❌ 1以上の半角数字で入力してください。", ephemeral=True)
+            if res.error == "no_recipe": return await reply(i2, f"❌ {target} のレシピが設定されていません。", ephemeral=True)
+            if not res.ok: return await reply(i2, short_text(res.shortfalls, target), ephemeral=True)
+            await reply(i2, f"✅ {target} を {q} 個制作しました（素材を自動消費）。", ephemeral=True)
         
-        sel.callback = lambda i2: i2.response.send_modal(GenericModal("制作数", "制作した個数（半角数字）", cb))
-        v.add_item(sel); await i.response.send_message("制作物の報告:", view=v, ephemeral=True)
+        v = TimedView()
+        PagedPicker(v, lambda: cache.product_index, on_pick, "制作した商品を選択", label)
+        await reply(i, "制作物の報告:", view=v, ephemeral=True)
 
     @discord.ui.button(label="💰 売上報告", style=discord.ButtonStyle.success, custom_id="v15_gen_sale")
     async def sale(self, i, b):
-        if not any(r.id == WORK_ROLE_ID for r in i.user.roles): return await i.response.send_message("❌ 出勤中のみ可能です。", ephemeral=True)
-        async with aiosqlite.connect(DB_PATH) as db:
-            prods = await (await db.execute("SELECT name, price FROM products")).fetchall()
-        if not prods: return await i.response.send_message("❌ 商品がありません。", ephemeral=True)
+        if not role_sync.has_role(i.user, i.guild.id, WORK_ROLE_ID): return await reply(i, "❌ 出勤中のみ可能です。", ephemeral=True)
+        await cache.ensure()
+        if not cache.product_index: return await reply(i, "❌ 商品がありません。", ephemeral=True)
         
-        v = discord.ui.View(); sel = discord.ui.Select(placeholder="販売した商品を選択")
-        for p, prc in prods: sel.add_option(label=f"{p} (単価: {prc}円)", value=f"{p}:{prc}")
+        # 表示した時点の単価・版を控えておき、報告時に変わっていたら受け付けない
+        shown = {}
+        def label(n):
+            p = cache.products[n]; shown[n] = (p.price, p.version)
+            return f"{n} (単価: {p.price}円)"
         
-        async def cb(i2, q):
-            name, price = sel.values[0].split(":"); q = int(q); amt = int(price) * q
-            async with aiosqlite.connect(DB_PATH) as db:
-                cur = await (await db.execute("SELECT current FROM products WHERE name=?", (name,))).fetchone()
-                if not cur or cur[0] < q: return await i2.response.send_message(f"❌ 商品在庫が足りません (現在: {cur[0] if cur else 0})", ephemeral=True)
-                
-                await db.execute("UPDATE products SET current = current - ? WHERE name=?", (q, name))
-                await db.execute("INSERT INTO sales_ranking (user_id, total_amount) VALUES (?,?) ON CONFLICT(user_id) DO UPDATE SET total_amount = total_amount + ?", (i2.user.id, amt, amt))
-                await db.commit()
-            
-            await add_audit(i2.user.id, "売上", f"{name} x{q} ({amt:,}円)")
-            await i2.response.send_message(f"💰 売上報告完了: {name} x{q} ({amt:,}円)", ephemeral=True)
+        def on_pick(i2, name):
+            return open_modal(i2, GenericModal("売上数", "販売した個数（半角数字）", lambda i3, q: cb(i3, name, q)))
+        
+        async def cb(i2, name, q):
+            q = parse_qty(q); price, ver = shown[name]
+            cur = cache.get_product(name)
+            res = TxResult(False, "stale_price") if cur and cur.version != ver else await sell_product(i2.user.id, name, q, expected_price=price)
+            if res.error == "stale_price": return await reply(i2, "❌ 単価が変更されています。売上報告を開き直してください。", ephemeral=True)
+            if res.error == "bad_qty": return await reply(i2, "❌ 1以上の半角数字で入力してください。", ephemeral=True)
+            if res.error == "no_product": return await reply(i2, f"❌ {name} は登録されていません。", ephemeral=True)
+            if not res.ok: return await reply(i2, f"❌ 商品在庫が足りません (現在: {res.shortfalls[0][2]})", ephemeral=True)
+            await reply(i2, f"💰 売上報告完了: {name} x{q} ({res.amount:,}円) 伝票 #{res.sale_id}", ephemeral=True)
             
-        sel.callback = lambda i2: i2.response.send_modal(GenericModal("売上数", "販売した個数（半角数字）", cb))
-        v.add_item(sel); await i.response.send_message("売上の報告:", view=v, ephemeral=True)
+        v = TimedView()
+        PagedPicker(v, lambda: cache.product_index, on_pick, "販売した商品を選択", label)
+        await reply(i, "売上の報告:", view=v, ephemeral=True)
 
 # ================= 7. 起動・メンテナンスコマンド =================
+# (キー, チャンネル, View, 本文)
+PANELS = (
+    ("admin", ADMIN_PANEL_CH, AdminPanel, "🔧 **管理者用・管理パネル**\n（ロール管理・統計・ログ確認用）"),
+    ("item", ITEM_PANEL_CH, ItemPanel, "📦 **管理者用・商品マスタパネル**\n（商品登録・レシピ・在庫調整用）"),
+    ("general", GENERAL_PANEL_CH, GeneralPanel, "🧾 **オムニス商会・業務パネル**\n（出退勤・制作報告・売上報告用）"),
+)
+PANEL_RETRY_SEC = (5, 30, 120)   # 起動時のパネル確認などが失敗したときの再試行間隔
+_panels_ready = False      # 起動時の処理がすべて成功したら True（以後の再接続では何もしない）
+_startup_done = set()      # 成功済みの処理（パネルのキー / "reconcile" / "dashboard"）。再試行では残りだけ流す
+_startup_lock = asyncio.Lock()
+
+async def warm_db():
+    # よく読むテーブルとインデックスのページをキャッシュに載せておく
+    await asyncio.gather(db.fetchone("SELECT COUNT(*) FROM work_logs WHERE end IS NULL"),
+                         db.fetchone("SELECT COUNT(*) FROM user_totals"),
+                         db.fetchone("SELECT MAX(id) FROM audit_logs"))
+
+async def startup():
+    """DB・キャッシュを準備し、永続Viewを登録する。ゲートウェイ接続前に1回だけ呼ばれる。"""
+    t = time.perf_counter()
+    await init_db()
+    await asyncio.gather(cache.load(), warm_db())
+    for _, _, view_cls, _ in PANELS: bot.add_view(view_cls())
+    audit.start(); role_sync.start()
+    if not audit_maintenance.is_running(): audit_maintenance.start()
+    if PERF_PROM_FILE and not perf_dump.is_running(): perf_dump.start()
+    print(f"startup ready in {(time.perf_counter() - t) * 1000:.0f}ms")
+
+async def _startup_step(name, fn):
+    """起動時処理を1つ流し、成功したら _startup_done に記録する。失敗は表示だけして False を返す。"""
+    if name in _startup_done: return True
+    try: ok = await fn()
+    except Exception as e:
+        print(f"startup {name} failed: {e!r}"); return False
+    if ok: _startup_done.add(name)
+    return ok
+
+async def _startup_pass():
+    async def panel(key, cid, view_cls, title):
+        res = await ensure_panel(key, ch, title, view_cls()) if (ch := bot.get_channel(cid)) else "no channel"
+        print(f"panel {key}: {res}")
+        return res in ("reused", "sent")
+
+    async def reconcile():
+        # 停止中に出退勤が途切れた分（剥奪漏れ・付与漏れ）を勤怠記録に合わせる
+        print(f"work role reconcile: {await reconcile_work_roles(bot.guilds)} queued")
+        return True
+
+    async def attach():
+        # 商品マスタパネルの下に在庫ダッシュボードを置く
+        if not (ch := bot.get_channel(ITEM_PANEL_CH)): return False
+        await dashboard.attach(ch)
+        return True
+
+    ok = all(await asyncio.gather(*(_startup_step(p[0], lambda p=p: panel(*p)) for p in PANELS)))
+    ok &= await _startup_step("reconcile", reconcile)   # パネルが失敗しても残りは流す
+    ok &= await _startup_step("dashboard", attach)
+    return ok
+
 @bot.event
 async def on_ready():
-    await init_db()
-    bot.add_view(AdminPanel()); bot.add_view(ItemPanel()); bot.add_view(GeneralPanel())
+    # on_ready は再接続のたびに呼ばれる。起動時の処理が全部成功するまでは、失敗した分だけ間隔を空けて流し直す
+    global _panels_ready
     print(f"Logged in as {bot.user}")
-    
-    # チャンネルの掃除（再起動時の自動メッセージ削除）とパネル送信
-    setup_data = [
-        (ADMIN_PANEL_CH, AdminPanel(), "🔧 **管理者用・管理パネル**\n（ロール管理・統計・ログ確認用）"), 
-        (ITEM_PANEL_CH, ItemPanel(), "📦 **管理者用・商品マスタパネル**\n（商品登録・レシピ・在庫調整用）"), 
-        (GENERAL_PANEL_CH, GeneralPanel(), "🧾 **オムニス商会・業務パネル**\n（出退勤・制作報告・売上報告用）")
-    ]
-    
-    for cid, view, title in setup_data:
-        ch = bot.get_channel(cid)
-        if ch:
-            await ch.purge(limit=20) # 直近のメッセージを削除
-            await ch.send(title, view=view)
+    async with _startup_lock:
+        for delay in (0,) + PANEL_RETRY_SEC:
+            if _panels_ready: return
+            if delay: await asyncio.sleep(delay)
+            if await _startup_pass():
+                _panels_ready = True; return
+        print(f"startup: not finished ({', '.join(sorted(_startup_done)) or 'none'} done), retrying on next reconnect")
+
+@bot.command(name="import")
+@commands.has_role(ADMIN_ROLE_ID)
+async def import_master(ctx):
+    if not ctx.message.attachments: return await ctx.send("❌ CSV / JSON ファイルを添付してください。")
+    att = ctx.message.attachments[0]
+    plan = parse_import(att.filename, await att.read())
+    if plan.errors: return await ctx.send("❌ 取り込めない行があります（何も変更していません）:\n" + "\n".join(plan.errors))
+    await ctx.send("🔍 **インポート内容の確認（まだ適用されていません）**\n" + plan.diff_text(), view=ImportConfirmView(plan, ctx.author.id))
+
+@bot.command(name="export")
+@commands.has_role(ADMIN_ROLE_ID)
+async def export_data(ctx, kind: str = "stock", month: str = None):
+    if kind not in EXPORT_KINDS: return await ctx.send("❌ 種別は stock / work / sales のいずれかです。")
+    try: f = await export_csv(kind, month)
+    except ValueError: return await ctx.send("❌ 月は YYYY-MM 形式で指定してください。")
+    await ctx.send(file=f)
+
+@bot.command(name="void")
+@commands.has_role(ADMIN_ROLE_ID)
+async def void_sale_cmd(ctx, sale_id: int):
+    res = await void_sale(ctx.author.id, sale_id)
+    if res.error == "no_sale": return await ctx.send(f"❌ 伝票 #{sale_id} は売上として存在しません。")
+    if res.error == "already_void": return await ctx.send(f"❌ 伝票 #{sale_id} は取消済みです。")
+    await ctx.send(f"↩️ 伝票 #{sale_id} を取り消しました（{res.amount:,}円・在庫を戻しました）。")
 
 @bot.command()
 @commands.has_role(ADMIN_ROLE_ID)
 async def restart(ctx):
     await ctx.send("♻️ Botを再起動しています...")
+    await asyncio.gather(audit.drain(), role_sync.drain())
+    await db.close()
     os.execv(sys.executable, ['python'] + sys.argv)
 
-bot.run(TOKEN)
-
+if __name__ == "__main__":
+    bot.run(TOKEN)